@@ -0,0 +1,820 @@
+#!/usr/bin/env python3
+
+'''
+--------------------------------------------------------------------------------
+Timings for the hot paths of ecodb_maker.py
+
+Usage:
+  ./ecodb_bench.py tokenizer -t /path/to/taxdump
+  ./ecodb_bench.py cleanseq --sizes 1 16 200
+  ./ecodb_bench.py generate --nodes 10000 3000000 --lengths 300 16500
+  ./ecodb_bench.py suite --nodes 10000 --json today.json --compare last.json
+  ./ecodb_bench.py compare last.json today.json
+  ./ecodb_bench.py golden
+
+Each benchmark prints one line per case: the case name, the best time
+over --repeat runs in seconds, and the speedup against the reference
+implementation when there is one.
+
+The suite runs on synthetic taxdumps and GenBank, EMBL and FASTA files
+written to --workdir by generate (or by suite itself when they are
+missing). They only depend on --seed and the sizes asked for, so runs
+on different days or machines time the same data. Every case runs in a
+forked process, whose peak memory is reported along with its best time
+and throughput.
+
+golden builds databases from synthetic data and checks the md5 of every
+file written against ecodb_golden.json, recorded from the Python 2
+version of ecodb_maker.py, so any change to the output shows up. It
+then runs a few checks of behaviours the digests do not cover.
+
+--------------------------------------------------------------------------------
+'''
+
+import re
+import os
+import sys
+import time
+import json
+import random
+import hashlib
+import marshal
+import argparse
+import platform
+import resource
+import functools
+from array import array
+
+import ecodb_maker
+import ecodb_reader
+
+parser = argparse.ArgumentParser(
+  description = 'Time the hot paths of ecodb_maker.py')
+
+parser.add_argument('benchmark',
+  choices = ['tokenizer', 'cleanseq', 'generate', 'suite', 'compare',
+             'golden'],
+  help = 'which benchmark to run; generate only writes the synthetic '
+         'data of the suite, compare compares two --json results, golden '
+         'checks the database files against recorded digests')
+
+parser.add_argument('results', nargs = '*',
+  help = 'for compare: the reference and the new --json result files')
+
+parser.add_argument('-t', '--taxonomy',
+  help = 'path to folder containing NCBI taxonomy files')
+
+parser.add_argument('-s', '--sizes',
+  type = float, nargs = '+', default = [1, 16, 200],
+  help = 'record sizes in megabases for the cleanseq benchmark '
+         '(default: 1 16 200)')
+
+parser.add_argument('-r', '--repeat',
+  type = int, default = 3,
+  help = 'number of runs per case; the best one is reported (default: 3)')
+
+parser.add_argument('-w', '--workdir',
+  default = 'ecodb_bench_data',
+  help = 'folder for the synthetic data of the suite '
+         '(default: ecodb_bench_data)')
+
+parser.add_argument('-n', '--nodes',
+  type = int, nargs = '+', default = [10000],
+  help = 'sizes of the synthetic taxdumps, from 10000 to 3000000 '
+         '(default: 10000)')
+
+parser.add_argument('-l', '--lengths',
+  type = int, nargs = '+', default = [300, 16500],
+  help = 'mean sequence lengths of the synthetic sequence files, from '
+         'amplicons to whole genomes (default: 300 16500)')
+
+parser.add_argument('-m', '--megabases',
+  type = float, default = 20,
+  help = 'amount of sequence in each synthetic sequence file (default: 20)')
+
+parser.add_argument('--seed',
+  type = int, default = 1,
+  help = 'seed of the synthetic data (default: 1)')
+
+parser.add_argument('-k', '--cases',
+  help = 'only run the suite cases whose name matches this regular expression')
+
+parser.add_argument('--json',
+  help = 'write the suite results to this file')
+
+parser.add_argument('--compare',
+  help = 'compare the suite results with this earlier --json file')
+
+parser.add_argument('--golden',
+  default = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                         'ecodb_golden.json'),
+  help = 'digests checked by golden (default: ecodb_golden.json beside '
+         'this script)')
+
+parser.add_argument('--record',
+  action = 'store_true',
+  help = 'make golden write the digests instead of checking them')
+
+parser.add_argument('--threshold',
+  type = float, default = 0.1,
+  help = 'slowdown, as a fraction, above which compare reports a '
+         'regression and exits with status 1 (default: 0.1)')
+
+def bestTime(function, repeat):
+    best = None
+    for i in range(repeat):
+        start = time.time()
+        result = function()
+        elapsed = time.time() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return best, result
+
+def report(name, elapsed, reference=None):
+    if reference is None:
+        sys.stdout.write('%-32s %10.3f\n' % (name, elapsed))
+    else:
+        sys.stdout.write('%-32s %10.3f %8.1fx\n' % (name, elapsed,
+                                                   reference / elapsed))
+
+#####
+#
+#
+# taxdump tokenizer
+#
+#
+#####
+
+# file, columns used by ecodb_maker, dmpRowIterator types, ColumnFile types
+_tokenizerCases = [('nodes.dmp'   , (0,1,2), (int,int,bytes.strip),
+                    (int,int,str,str,str,bool,int,bool,int,bool,bool,bool,str)),
+                   ('names.dmp'   , (0,1,3), (int,bytes.strip,bytes.strip),
+                    (int,str,str,str)),
+                   ('merged.dmp'  , (0,1)  , (int,int),
+                    (int,int,str)),
+                   ('delnodes.dmp', (0,)   , (int,),
+                    (int,str))]
+
+def _asBytes(value):
+    if isinstance(value, str):
+        return value.encode('latin-1')
+    return value
+
+def columnFileRows(file, columns, types):
+    # ColumnFile reads text, dmpRowIterator bytes
+    rows = ecodb_maker.ColumnFile(open(file, encoding='latin-1'), sep='|',
+                                  types=types)
+    return [tuple(_asBytes(row[c]) for c in columns) for row in rows]
+
+def dmpRows(file, columns, types):
+    return list(ecodb_maker.dmpRowIterator(file, columns, types))
+
+def benchTokenizer(args):
+    if args.taxonomy is None:
+        parser.error('the tokenizer benchmark needs --taxonomy')
+    for name,columns,types,oldTypes in _tokenizerCases:
+        file = '%s/%s' % (args.taxonomy, name)
+        old,expected = bestTime(lambda: columnFileRows(file, columns, oldTypes),
+                                args.repeat)
+        report('ColumnFile %s' % name, old)
+        new,rows = bestTime(lambda: dmpRows(file, columns, types),
+                            args.repeat)
+        report('dmpRowIterator %s' % name, new, old)
+        assert rows == expected, 'tokenizers disagree on %s' % name
+
+#####
+#
+#
+# ORIGIN block cleaning
+#
+#
+#####
+
+_oldCleanSeq = re.compile(b'[ \n0-9]+')
+
+def oldCleanSeq(block):
+    return _oldCleanSeq.sub(b'',block.upper())
+
+def originBlock(length, seed=1):
+    '''
+    A GenBank ORIGIN block holding a random sequence of length bases.
+    '''
+    generator = random.Random(seed)
+    line = ''.join(generator.choice('acgt') for i in range(60))
+    line = ' '.join(line[i:i+10] for i in range(0,60,10))
+    lines = ['%9d %s\n' % (i+1, line) for i in range(0,length,60)]
+    return ('\n' + ''.join(lines)).encode()
+
+def benchCleanSeq(args):
+    for size in args.sizes:
+        block = originBlock(int(size * 1000000))
+        old,expected = bestTime(lambda: oldCleanSeq(block), args.repeat)
+        report('regex cleanSeq %gMb' % size, old)
+        new,result = bestTime(lambda: ecodb_maker.cleanSeq(block), args.repeat)
+        report('translate cleanSeq %gMb' % size, new, old)
+        assert result == expected, 'cleanSeq results differ'
+
+#####
+#
+#
+# Synthetic data
+#
+#
+#####
+
+# Only Random.random is used: it gives the same numbers for the same
+# seed on every Python version, where choice, shuffle or randint do not.
+
+_rankNames = ['superkingdom','kingdom','phylum','class','order','family',
+              'genus','species','subspecies']
+
+_syllables = ['ba','ce','di','fo','gu','ha','ke','li','mo','nu','pa','re',
+              'si','to','vu','xa','ye','zo','an','el','ix','os','ur','th']
+
+def syntheticWord(rand):
+    word = ''.join(_syllables[int(rand()*len(_syllables))] 
+                   for i in range(2 + int(rand()*3)))
+    return word
+    
+def syntheticName(rand,depth):
+    name = syntheticWord(rand).capitalize()
+    if depth >= 7:
+        name += ' ' + syntheticWord(rand)
+    if rand() < 0.05:
+        name = 'uncultured ' + name
+    return name
+
+def writeTaxdump(taxdir,nodes,seed=1):
+    '''
+    Write a synthetic NCBI taxdump of nodes taxa to taxdir and return
+    the taxids sequences can be attached to. Every taxon hangs under a
+    random earlier one and gets the rank of its depth. nodes.dmp lines
+    are shuffled as in the real dumps. names.dmp also holds synonyms
+    and common names, and merged.dmp and delnodes.dmp use the taxids
+    left unused.
+    '''
+    rand = random.Random(seed).random
+    if not os.path.isdir(taxdir):
+        os.makedirs(taxdir)
+    taxids  = array('i',[1])
+    parents = array('i',[1])
+    depths  = array('b',[0])
+    unused  = []
+    taxid = 1
+    for i in range(nodes - 1):
+        step = 1 + int(rand()*3)
+        if step > 1:
+            unused.append(taxid + 1)
+        taxid += step
+        parent = int(rand()*len(taxids))
+        taxids.append(taxid)
+        parents.append(taxids[parent])
+        depths.append(min(depths[parent] + 1, 127))
+        
+    order = list(range(len(taxids)))
+    for i in range(len(order) - 1,0,-1):
+        j = int(rand()*(i + 1))
+        order[i],order[j] = order[j],order[i]
+    output = open(os.path.join(taxdir,'nodes.dmp'),'w')
+    for i in order:
+        if 0 < depths[i] <= len(_rankNames):
+            rank = _rankNames[depths[i] - 1]
+        else:
+            rank = 'no rank'
+        output.write('%d\t|\t%d\t|\t%s\t|\t\t|\t0\t|\t1\t|\t1\t|\t1\t|'
+                     '\t2\t|\t1\t|\t0\t|\t0\t|\t\t|\n' % 
+                     (taxids[i],parents[i],rank))
+    output.close()
+    
+    output = open(os.path.join(taxdir,'names.dmp'),'w')
+    for i in range(len(taxids)):
+        output.write('%d\t|\t%s\t|\t\t|\tscientific name\t|\n' % 
+                     (taxids[i],syntheticName(rand,depths[i])))
+        if rand() < 0.3:
+            output.write('%d\t|\t%s\t|\t\t|\tsynonym\t|\n' % 
+                         (taxids[i],syntheticName(rand,depths[i])))
+        if rand() < 0.2:
+            output.write('%d\t|\t%s\t|\t\t|\tgenbank common name\t|\n' % 
+                         (taxids[i],syntheticWord(rand)))
+    output.close()
+    
+    merged = open(os.path.join(taxdir,'merged.dmp'),'w')
+    deleted = open(os.path.join(taxdir,'delnodes.dmp'),'w')
+    for old in unused:
+        draw = rand()
+        if draw < 0.02:
+            merged.write('%d\t|\t%d\t|\n' % 
+                         (old,taxids[int(rand()*len(taxids))]))
+        elif draw < 0.03:
+            deleted.write('%d\t|\n' % old)
+    merged.close()
+    deleted.close()
+    
+    species = [taxids[i] for i in range(len(taxids)) if depths[i] >= 8]
+    if not species:
+        species = list(taxids)
+    return species
+
+_sequenceFormats = [('genbank','gb'),('embl','embl'),('fasta','fasta')]
+
+def syntheticSequence(rand,pool,length):
+    # 60 base pieces of a random pool, so whole genomes are cheap to make
+    pieces = []
+    for i in range(0,length,60):
+        start = int(rand()*(len(pool) - 60))
+        pieces.append(pool[start:start + min(60,length - i)])
+    return ''.join(pieces)
+
+def genbankRecord(id,definition,taxid,seq):
+    lines = ['LOCUS       %-16s %11d bp    DNA     linear   SYN 01-JAN-2016\n' 
+             % (id,len(seq)),
+             'DEFINITION  %s,\n            partial sequence.\n' % definition,
+             'ACCESSION   %s\nVERSION     %s.1\n' % (id,id),
+             'FEATURES             Location/Qualifiers\n',
+             '     source          1..%d\n' % len(seq),
+             '                     /db_xref="taxon:%d"\n' % taxid,
+             'ORIGIN      \n']
+    for i in range(0,len(seq),60):
+        line = seq[i:i + 60]
+        lines.append('%9d %s\n' % (i + 1,' '.join(line[j:j + 10] 
+                                   for j in range(0,len(line),10))))
+    lines.append('//\n')
+    return ''.join(lines)
+
+def emblRecord(id,definition,taxid,seq):
+    lines = ['ID   %s; SV 1; linear; genomic DNA; STD; SYN; %d BP.\nXX\n' 
+             % (id,len(seq)),
+             'AC   %s;\nXX\n' % id,
+             'DE   %s,\nDE   partial sequence.\nXX\n' % definition,
+             'FH   Key             Location/Qualifiers\n',
+             'FT   source          1..%d\n' % len(seq),
+             'FT                   /db_xref="taxon:%d"\nXX\n' % taxid,
+             'SQ   Sequence %d BP;\n' % len(seq)]
+    for i in range(0,len(seq),60):
+        line = seq[i:i + 60]
+        lines.append('     %-65s %9d\n' % (' '.join(line[j:j + 10] 
+                                           for j in range(0,len(line),10)),
+                                           i + len(line)))
+    lines.append('//\n')
+    return ''.join(lines)
+
+def fastaRecord(id,definition,taxid,seq):
+    lines = ['>%s taxid=%d; %s, partial sequence.\n' % (id,taxid,definition)]
+    lines.extend(seq[i:i + 60] + '\n' for i in range(0,len(seq),60))
+    return ''.join(lines)
+
+_recordWriters = {'genbank': genbankRecord,
+                  'embl'   : emblRecord,
+                  'fasta'  : fastaRecord}
+
+def writeSequences(file,format,taxids,megabases,length,seed=1):
+    '''
+    Write about megabases of random sequences, of lengths within 20%
+    of length, in format. 2% of them point to a taxid missing from the
+    taxdump, as real downloads do. Return the number of records.
+    '''
+    rand = random.Random(seed).random
+    pool = ''.join('acgt'[int(rand()*4)] for i in range(1 << 16))
+    writer = _recordWriters[format]
+    output = open(file,'w')
+    total = int(megabases * 1000000)
+    count = 0
+    while total > 0 or not count:
+        seq = syntheticSequence(rand,pool,
+                                max(1,int(length * (0.8 + rand()*0.4))))
+        if rand() < 0.02:
+            taxid = 999999999
+        else:
+            taxid = taxids[int(rand()*len(taxids))]
+        definition = 'Synthetic record %d %s gene' % (count,syntheticWord(rand))
+        output.write(writer('SYN%08d' % count,definition,taxid,seq))
+        total -= len(seq)
+        count += 1
+    output.close()
+    return count
+
+class SyntheticData(object):
+    '''
+    Paths of the synthetic data of the suite in workdir, written on
+    first use. The file names hold the sizes and the seed, so data
+    made with other settings is never mixed up.
+    '''
+    
+    def __init__(self,workdir,seed=1,megabases=20):
+        self.workdir   = workdir
+        self.seed      = seed
+        self.megabases = megabases
+        
+    def taxdump(self,nodes):
+        taxdir = os.path.join(self.workdir,'taxdump-%d-s%d' % (nodes,self.seed))
+        species = os.path.join(taxdir,'species')
+        if not os.path.exists(species):
+            sys.stderr.write('Writing %s...\n' % taxdir)
+            taxids = writeTaxdump(taxdir,nodes,self.seed)
+            tmp = species + '.tmp'
+            output = open(tmp,'wb')
+            marshal.dump(taxids,output)
+            output.close()
+            os.rename(tmp,species)
+        return taxdir
+    
+    def species(self,nodes):
+        input = open(os.path.join(self.taxdump(nodes),'species'),'rb')
+        taxids = marshal.load(input)
+        input.close()
+        return taxids
+    
+    def sequences(self,format,length,nodes):
+        extension = dict(_sequenceFormats)[format]
+        file = os.path.join(self.workdir,'seqs-%d-%gMb-n%d-s%d.%s' % 
+                            (length,self.megabases,nodes,self.seed,extension))
+        if not os.path.exists(file):
+            sys.stderr.write('Writing %s...\n' % file)
+            tmp = file + '.tmp'
+            writeSequences(tmp,format,self.species(nodes),self.megabases,
+                           length,self.seed)
+            os.rename(tmp,file)
+        return file
+
+def benchGenerate(args):
+    data = SyntheticData(args.workdir,args.seed,args.megabases)
+    for nodes in args.nodes:
+        sys.stdout.write('%s\n' % data.taxdump(nodes))
+    for length in args.lengths:
+        for format,extension in _sequenceFormats:
+            sys.stdout.write('%s\n' % data.sequences(format,length,
+                                                     args.nodes[0]))
+
+#####
+#
+#
+# Suite
+#
+#
+#####
+
+class Case(object):
+    '''
+    A timed piece of ecodb_maker. setup prepares, untimed, what run
+    works on; one run processes units of unit (taxa or bytes), for
+    the rates.
+    '''
+    
+    def __init__(self,name,run,setup=None,units=None,unit='taxa'):
+        self.name  = name
+        self.run   = run
+        self.setup = setup
+        self.units = units
+        self.unit  = unit
+
+def peakRss():
+    return ecodb_maker.maxRssKb(resource.RUSAGE_SELF)
+
+def runCase(case,repeat):
+    '''
+    Run a case in a forked process, so that its peak memory is not
+    hidden by the cases before it, and return its measures.
+    '''
+    read,write = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        os.close(read)
+        try:
+            state = case.setup() if case.setup is not None else None
+            setup = peakRss()
+            elapsed,result = bestTime(lambda: case.run(state),repeat)
+            measures = {'seconds'     : elapsed,
+                        'setup_rss_kb': setup,
+                        'peak_rss_kb' : peakRss()}
+            if case.units is not None:
+                measures['units'] = case.units
+                measures['unit']  = case.unit
+                measures['units_per_second'] = case.units / elapsed
+        except Exception as e:
+            measures = {'error': '%s: %s' % (e.__class__.__name__,e)}
+        output = os.fdopen(write,'wb')
+        marshal.dump(measures,output)
+        output.close()
+        os._exit(0)
+    os.close(write)
+    input = os.fdopen(read,'rb')
+    try:
+        measures = marshal.load(input)
+    except EOFError:
+        measures = {'error': 'case process died'}
+    input.close()
+    os.waitpid(pid,0)
+    return measures
+
+def taxonomyCases(data,nodes,tmpdir):
+    taxdir = data.taxdump(nodes)
+    cache  = os.path.join(tmpdir,'taxonomy.ecocache')
+    prefix = 'taxdump %d: ' % nodes
+    
+    def loadTaxonomy():
+        return ecodb_maker.cachedTaxonomyDump(taxdir,cache)
+    
+    def writeCache(taxonomy):
+        ecodb_maker.writeTaxonomyCache(cache,taxdir,taxonomy)
+        
+    def readCache(state):
+        if ecodb_maker.readTaxonomyCache(cache,taxdir) is None:
+            raise ValueError('taxonomy cache not used')
+        
+    def writeNames(taxonomy):
+        # names are sorted in place, so every run sorts a fresh copy
+        names = taxonomy[2]
+        names = ecodb_maker.NameTable(names.strings,array('i',names.names),
+                                      array('B',names.classes),
+                                      array('i',names.taxa),names.classNames)
+        ecodb_maker.ecoNameWriter(os.path.join(tmpdir,'bench.ndx'),names)
+        
+    return [Case(prefix + 'readNodeTable',
+                 lambda state: ecodb_maker.readNodeTable(
+                     os.path.join(taxdir,'nodes.dmp')),
+                 units=nodes),
+            Case(prefix + 'readTaxonomyDump',
+                 lambda state: ecodb_maker.readTaxonomyDump(taxdir),
+                 units=nodes),
+            Case(prefix + 'writeTaxonomyCache',writeCache,
+                 lambda: ecodb_maker.readTaxonomyDump(taxdir),units=nodes),
+            Case(prefix + 'readTaxonomyCache',readCache,
+                 loadTaxonomy,units=nodes),
+            Case(prefix + 'ecoTaxWriter',
+                 lambda taxonomy: ecodb_maker.ecoTaxWriter(
+                     os.path.join(tmpdir,'bench.tdx'),taxonomy[0]),
+                 loadTaxonomy,units=nodes),
+            Case(prefix + 'ecoNameWriter',writeNames,loadTaxonomy),
+            Case(prefix + 'LineageIndex',
+                 lambda taxonomy: ecodb_maker.LineageIndex(taxonomy).rankRows(
+                     'family'),
+                 loadTaxonomy,units=nodes)]
+
+def sequenceCases(data,format,length,nodes,tmpdir):
+    file   = data.sequences(format,length,nodes)
+    taxdir = data.taxdump(nodes)
+    cache  = os.path.join(tmpdir,'taxonomy.ecocache')
+    prefix = '%s %d: ' % (format,length)
+    parser = ecodb_maker.infile_parser_picker(format)
+    size   = os.path.getsize(file)
+    
+    def entries(state=None):
+        return list(parser.entryIterator(file))
+    
+    def parsed():
+        return [parser.entryParser(entry) for entry in entries()]
+    
+    def packable():
+        index = ecodb_maker.cachedTaxonomyDump(taxdir,cache)[3]
+        rep = []
+        for sq in parsed():
+            sq['taxid'] = index.get(sq['taxid'])
+            if sq['taxid'] is not None:
+                rep.append(sq)
+        return rep
+    
+    def writeSequences(index):
+        ecodb_maker.ecoSeqWriter(os.path.join(tmpdir,'bench.sdx'),file,
+                                 index,parser)
+        
+    return [Case(prefix + 'entries',entries,units=size,unit='B'),
+            Case(prefix + 'parse',
+                 lambda entries: [parser.entryParser(e) for e in entries],
+                 entries,units=size,unit='B'),
+            Case(prefix + 'ecoSeqPacker',
+                 lambda sqs: [ecodb_maker.ecoSeqPacker(sq) for sq in sqs],
+                 packable,units=size,unit='B'),
+            Case(prefix + 'ecoSeqWriter',writeSequences,
+                 lambda: ecodb_maker.cachedTaxonomyDump(taxdir,cache)[3],
+                 units=size,unit='B')]
+
+def suiteCases(args,tmpdir):
+    data = SyntheticData(args.workdir,args.seed,args.megabases)
+    cases = []
+    for nodes in args.nodes:
+        cases.extend(taxonomyCases(data,nodes,tmpdir))
+    for length in args.lengths:
+        for format,extension in _sequenceFormats:
+            cases.extend(sequenceCases(data,format,length,args.nodes[0],tmpdir))
+    if args.cases:
+        selected = re.compile(args.cases)
+        cases = [case for case in cases if selected.search(case.name)]
+    return cases
+
+def suiteReport(name,measures):
+    if 'error' in measures:
+        sys.stdout.write('%-40s %s\n' % (name,measures['error']))
+        return
+    rate = ''
+    if 'units_per_second' in measures:
+        rate = '%10.4g %s/s' % (measures['units_per_second'],measures['unit'])
+    sys.stdout.write('%-40s %10.3f %20s %8.1fMB\n' % 
+                     (name,measures['seconds'],rate,
+                      measures['peak_rss_kb'] / 1024.0))
+
+def benchSuite(args):
+    tmpdir = os.path.join(args.workdir,'tmp-%d' % os.getpid())
+    os.makedirs(tmpdir)
+    results = {'version'  : 1,
+               'python'   : platform.python_version(),
+               'machine'  : platform.machine(),
+               'seed'     : args.seed,
+               'nodes'    : args.nodes,
+               'lengths'  : args.lengths,
+               'megabases': args.megabases,
+               'repeat'   : args.repeat,
+               'cases'    : {}}
+    try:
+        # the data is made before any case runs, so that no case times it
+        for case in suiteCases(args,tmpdir):
+            measures = runCase(case,args.repeat)
+            results['cases'][case.name] = measures
+            suiteReport(case.name,measures)
+    finally:
+        for name in os.listdir(tmpdir):
+            os.remove(os.path.join(tmpdir,name))
+        os.rmdir(tmpdir)
+    if args.json:
+        output = open(args.json,'w')
+        json.dump(results,output,indent=2,sort_keys=True,separators=(',',': '))
+        output.write('\n')
+        output.close()
+    if args.compare:
+        reference = json.load(open(args.compare))
+        if compareResults(reference,results,args.threshold):
+            sys.exit(1)
+
+# cases faster than this are too noisy to be called regressions
+_compareFloor = 0.01
+
+def compareResults(reference,results,threshold):
+    '''
+    Print the time ratio of every case found in both results and
+    return the names of the ones slower by more than threshold.
+    '''
+    sys.stdout.write('%-40s %10s %10s %8s %10s\n' % 
+                     ('case','reference','new','ratio','memory'))
+    regressions = []
+    for name in sorted(results['cases']):
+        new = results['cases'][name]
+        old = reference['cases'].get(name)
+        if old is None or 'seconds' not in old or 'seconds' not in new:
+            continue
+        ratio = new['seconds'] / old['seconds']
+        flag = ''
+        if ratio > 1 + threshold and new['seconds'] > _compareFloor:
+            flag = '  REGRESSION'
+            regressions.append(name)
+        sys.stdout.write('%-40s %10.3f %10.3f %7.2fx %8.1fMB%s\n' % 
+                         (name,old['seconds'],new['seconds'],ratio,
+                          (new['peak_rss_kb'] - old['peak_rss_kb']) / 1024.0,
+                          flag))
+    return regressions
+
+def benchCompare(args):
+    if len(args.results) != 2:
+        parser.error('compare needs the reference and the new result files')
+    reference,results = [json.load(open(file)) for file in args.results]
+    if compareResults(reference,results,args.threshold):
+        sys.exit(1)
+
+#####
+#
+#
+# Golden files
+#
+#
+#####
+
+# the data behind the recorded digests; changing it means recording again
+_goldenData = {'seed': 1, 'nodes': 10000, 'megabases': 2, 'lengths': [300, 16500]}
+
+def fileDigest(file):
+    input = open(file,'rb')
+    digest = hashlib.md5(input.read()).hexdigest()
+    input.close()
+    return digest
+
+def goldenDigests(workdir):
+    '''
+    Build a database from every synthetic sequence file, with one and
+    two processes, and return the md5 of every file written.
+    '''
+    data = SyntheticData(workdir,_goldenData['seed'],_goldenData['megabases'])
+    nodes = _goldenData['nodes']
+    taxdir = data.taxdump(nodes)
+    tmpdir = os.path.join(workdir,'golden-%d' % os.getpid())
+    os.makedirs(tmpdir)
+    digests = {}
+    try:
+        taxonomy = ecodb_maker.readTaxonomyDump(taxdir)
+        for length in _goldenData['lengths']:
+            for format,extension in _sequenceFormats:
+                file = data.sequences(format,length,nodes)
+                for jobs in (1,2):
+                    name = '%s-%d-j%d' % (format,length,jobs)
+                    prefix = os.path.join(tmpdir,name)
+                    fasta = open(prefix + '.fasta','wb')
+                    ecodb_maker.ecoDBWriter(prefix,taxonomy,[file],jobs,
+                                            fasta=fasta)
+                    fasta.close()
+                    for suffix in ('.rdx','.tdx','.ndx','_001.sdx','.fasta'):
+                        digests[name + suffix] = fileDigest(prefix + suffix)
+    finally:
+        for name in os.listdir(tmpdir):
+            os.remove(os.path.join(tmpdir,name))
+        os.rmdir(tmpdir)
+    return digests
+
+def checkNameOrder(workdir):
+    '''
+    NameTable.sortByName gives the order of nameCmp.
+    '''
+    data = SyntheticData(workdir,_goldenData['seed'],_goldenData['megabases'])
+    names = ecodb_maker.readTaxonomyDump(data.taxdump(_goldenData['nodes']))[2]
+    reference = sorted(names,key=functools.cmp_to_key(ecodb_maker.nameCmp))
+    names.sortByName()
+    return list(names) == reference
+
+def checkSpeciesCap(workdir):
+    '''
+    With --max-per-species 1, a species with two subspecies keeps a
+    sequence of each.
+    '''
+    tmpdir = os.path.join(workdir,'cap-%d' % os.getpid())
+    os.makedirs(tmpdir)
+    try:
+        # 1 root, 2 genus, 3 species, 4 and 5 subspecies
+        nodes = open(os.path.join(tmpdir,'nodes.dmp'),'w')
+        names = open(os.path.join(tmpdir,'names.dmp'),'w')
+        for taxid,parent,rank in ((1,1,'no rank'),(2,1,'genus'),
+                                  (3,2,'species'),(4,3,'subspecies'),
+                                  (5,3,'subspecies')):
+            nodes.write('%d\t|\t%d\t|\t%s\t|\t\t|\n' % (taxid,parent,rank))
+            names.write('%d\t|\ttaxon %d\t|\t\t|\tscientific name\t|\n' % 
+                        (taxid,taxid))
+        nodes.close()
+        names.close()
+        for name in ('merged.dmp','delnodes.dmp'):
+            open(os.path.join(tmpdir,name),'w').close()
+        rand = random.Random(1).random
+        file = os.path.join(tmpdir,'cap.gb')
+        output = open(file,'w')
+        for id,taxid in (('A1',4),('A2',4),('B1',5),('B2',5)):
+            seq = ''.join('ACGT'[int(rand()*4)] for i in range(200))
+            output.write(genbankRecord(id,'record ' + id,taxid,seq))
+        output.close()
+        taxonomy = ecodb_maker.readTaxonomyDump(tmpdir)
+        prefix = os.path.join(tmpdir,'cap')
+        dedup = ecodb_maker.SeqDeduplicator(taxonomy,prefix + '.collapsed.tsv',
+                                            True,1)
+        ecodb_maker.ecoDBWriter(prefix,taxonomy,[file],dedup=dedup)
+        with ecodb_reader.EcoDatabase(prefix) as db:
+            taxids = set(db.countByTaxon())
+    finally:
+        for name in os.listdir(tmpdir):
+            os.remove(os.path.join(tmpdir,name))
+        os.rmdir(tmpdir)
+    return taxids == set([4,5])
+
+_goldenChecks = [('name order',checkNameOrder),
+                 ('species cap',checkSpeciesCap)]
+
+def benchGolden(args):
+    digests = goldenDigests(args.workdir)
+    if args.record:
+        output = open(args.golden,'w')
+        json.dump({'data': _goldenData, 'digests': digests},output,
+                  indent=2,sort_keys=True,separators=(',',': '))
+        output.write('\n')
+        output.close()
+        sys.stdout.write('%d digests written to %s\n' % 
+                         (len(digests),args.golden))
+        return
+    golden = json.load(open(args.golden))['digests']
+    failed = 0
+    for name in sorted(golden):
+        if digests.get(name) != golden[name]:
+            sys.stdout.write('%-32s differs\n' % name)
+            failed += 1
+    sys.stdout.write('%d of %d files identical\n' % 
+                     (len(golden) - failed,len(golden)))
+    for name,check in _goldenChecks:
+        if check(args.workdir):
+            sys.stdout.write('%-32s ok\n' % name)
+        else:
+            sys.stdout.write('%-32s failed\n' % name)
+            failed += 1
+    if failed:
+        sys.exit(1)
+
+BENCHMARKS = {'tokenizer': benchTokenizer,
+              'cleanseq' : benchCleanSeq,
+              'generate' : benchGenerate,
+              'suite'    : benchSuite,
+              'compare'  : benchCompare,
+              'golden'   : benchGolden}
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+    BENCHMARKS[args.benchmark](args)
@@ -1,4 +1,4 @@
-#!/usr/bin/env python
+#!/usr/bin/env python3
 
 '''
 --------------------------------------------------------------------------------
@@ -9,7 +9,12 @@ Author: Jimmy O'Donnell <jodonnellbio@gmail.com>
 
 NOTES: 
   - removed option to use taxdb; I could find no documentation about its usage
-  - removed progress bar; it didn't work right. Use module progressbar2
+  - removed progress bar; it didn't work right. A progress line is now
+    drawn on terminals, and phase timings, throughput and peak memory
+    are printed at the end (and saved as JSON with --report)
+  - ported to Python 3. Files are read and written as bytes all the way,
+    so the output is byte-identical to the Python 2 version's
+    (./ecodb_bench.py golden checks it)
 
 TODO: if no taxonomy, download and unzip
 TODO: write metadata file:
@@ -21,54 +26,170 @@ TODO: write metadata file:
 
 import re
 import gzip
+import zlib
 import struct
 import sys
 import argparse
 import os
+import marshal
+import hashlib
+import multiprocessing
+import itertools
+import functools
+import collections
+import mmap
+import string
+import glob
+import tarfile
+import tempfile
+import shutil
+import time
+import json
+import resource
+from array import array
 from datetime import datetime
 
 parser = argparse.ArgumentParser(
   description = 'Create a database for use with ecoPrimers and ecoPCR')
 
 parser.add_argument('-i', '--input', 
-  help = 'input file containing DNA sequences in GenBank format', 
+  help = 'input file containing DNA sequences in GenBank format '
+         '(- reads them from standard input, e.g. from get_genbank.py -o -)', 
   required = True)
 
 parser.add_argument('-t', '--taxonomy',
-  help = 'path to folder containing NCBI taxonomy files', 
+  help = 'path to folder containing NCBI taxonomy files (plain or .gz), '
+         'or to taxdump.tar.gz itself', 
   required = True)
 
 parser.add_argument('-o', '--output',
   help = 'path to output', 
   required = True)
 
-def infile_type_checker(infilepath):
+parser.add_argument('--taxonomy-cache',
+  help = 'path to the compiled taxonomy cache '
+         '(default: taxonomy.ecocache inside the taxonomy folder)', 
+  required = False)
+
+parser.add_argument('-j', '--jobs',
+  help = 'number of processes used to parse and compress sequences '
+         '(default: 1)', 
+  type = int, default = 1)
+
+parser.add_argument('--index-input',
+  help = 'save the record offsets of the input beside it (as .ecoidx) '
+         'so that later runs do not have to scan it again', 
+  action = 'store_true')
+
+parser.add_argument('--input-records',
+  help = 'only read records START to STOP of the input, counted from 0 '
+         'and STOP left out (either may be omitted); with --index-input, '
+         'reading starts straight at record START', 
+  metavar = 'START:STOP')
+
+parser.add_argument('--shard-size',
+  help = 'start a new .sdx file once the current one reaches this size '
+         'in megabytes', 
+  type = float)
+
+parser.add_argument('--shard-records',
+  help = 'start a new .sdx file once the current one holds this many '
+         'sequences', 
+  type = int)
+
+parser.add_argument('-u', '--update',
+  help = 'add new and changed sequences to an existing database with '
+         'the same output name instead of rebuilding it', 
+  action = 'store_true')
+
+parser.add_argument('--fasta-out',
+  help = 'also write the sequences put in the database to this FASTA file', 
+  required = False)
+
+parser.add_argument('--report',
+  help = 'write the timings, throughput and peak memory of the build to '
+         'this file as JSON', 
+  required = False)
+
+parser.add_argument('--include-taxid',
+  help = 'only put in the database the sequences of taxa under this taxid '
+         '(can be repeated)', 
+  type = int, action = 'append', metavar = 'TAXID')
+
+parser.add_argument('--exclude-taxid',
+  help = 'leave out the sequences of taxa under this taxid '
+         '(can be repeated)', 
+  type = int, action = 'append', metavar = 'TAXID')
+
+parser.add_argument('--prune-taxonomy',
+  help = 'with --include-taxid/--exclude-taxid, only write the selected '
+         'taxa and their ancestors to the taxonomy files', 
+  action = 'store_true')
+
+parser.add_argument('--dedup',
+  help = 'put identical sequences of the same taxon in the database once', 
+  action = 'store_true')
+
+parser.add_argument('--max-per-species',
+  help = 'put at most this many sequences of each species (or of each '
+         'taxon above species level) in the database, besides the first '
+         'one of each taxon', 
+  type = int, metavar = 'N')
+
+parser.add_argument('--dedup-map',
+  help = 'with --dedup/--max-per-species, list the sequences left out '
+         'in this TSV file (default: output name + .collapsed.tsv)', 
+  required = False)
+
+parser.add_argument('--no-taxonomy-cache',
+  help = 'always parse the NCBI taxonomy files; do not read or write a cache', 
+  action = 'store_true')
+
+def infile_type_checker(infilepath, first_line=None):
     
-    with open(infilepath, 'r') as f:
+    if first_line is None:
+        f = universalOpen(infilepath)
         first_line = f.readline()
-        first_part = str.split(first_line)[0]
+        f.close()
+    first_part = first_line.split()[0]
 
     # guess_method = "contents"
-    if first_part == 'LOCUS':
+    if first_part == b'LOCUS':
         file_type = 'genbank'
-    elif first_part == 'ID':
+    elif first_part == b'ID':
         file_type = 'embl'
-    elif first_part[0] == '>':
+    elif first_part[:1] == b'>':
         file_type = 'fasta'
     else:
         # guess_method = "extension"
-        infile_ext = os.path.splitext(infilepath)[1].lower()
-        if infile_ext in ('.gb'):
+        infile_base,infile_ext = os.path.splitext(infilepath.lower())
+        if infile_ext in ('.gz', '.bgz'):
+            infile_ext = os.path.splitext(infile_base)[1]
+        if infile_ext in ('.gb', '.gbk'):
             file_type = 'genbank'
-        if infile_ext in ('.embl'):
+        elif infile_ext in ('.embl',):
             file_type = 'embl'
-        if infile_ext in ('.fa', '.fsa', '.fasta'):
+        elif infile_ext in ('.fa', '.fsa', '.fasta'):
             file_type = 'fasta'
         else:
             raise ValueError('could not guess input file type')
     
     return(file_type)
 
+def infile_opener(infilepath):
+    '''
+    Return the type of an input and what to read it from. Standard
+    input (-) cannot be read twice, so its first line is kept to guess
+    the type and put back in front of the remaining lines.
+    '''
+    if infilepath != '-':
+        return infile_type_checker(infilepath), infilepath
+    first_line = sys.stdin.buffer.readline()
+    if not first_line.strip():
+        raise ValueError('no sequences on standard input')
+    infile_type = infile_type_checker(infilepath, first_line)
+    return infile_type, itertools.chain([first_line], sys.stdin.buffer)
+
 #####
 #
 #
@@ -77,21 +198,338 @@ def infile_type_checker(infilepath):
 #
 #####
 
-def universalOpen(file):
+_gzipMagic = b'\x1f\x8b'
+
+def universalOpen(file,jobs=1):
+    '''
+    Open a file name for reading, in binary mode. gzip files, told
+    apart by their magic number rather than their extension, are read
+    through a GzipReader; bgzip ones are inflated on jobs processes
+    when jobs > 1. Anything else than a name is returned as is.
+    '''
     if isinstance(file,str):
-        if file[-3:] == '.gz':
-            rep = gzip.open(file)
+        rep = open(file,'rb')
+        magic = rep.read(16)
+        rep.close()
+        if magic[:2] != _gzipMagic:
+            rep = open(file,'rb')
+        elif jobs > 1 and isBgzf(magic):
+            rep = BgzfReader(file,jobs)
         else:
-            rep = open(file)
+            rep = GzipReader(file)
     else:
         rep = file
     return rep
 
 def universalTell(file):
+    '''
+    Position in the file, or None for pipes and other streams that
+    cannot tell. Compressed files give their position in the
+    compressed data.
+    '''
     if isinstance(file, gzip.GzipFile):
-        file=file.myfileobj
-    return file.tell()
+        file=file.fileobj
+    try:
+        return file.tell()
+    except (AttributeError, OSError):
+        return None
+
 
+def isBgzf(header):
+    '''
+    True when header starts a BGZF block: a gzip member whose only
+    extra subfield is 'BC', holding the size of the block.
+    '''
+    return (header[:4] == b'\x1f\x8b\x08\x04' and 
+            header[10:16] == b'\x06\x00BC\x02\x00')
+
+class GzipReader(object):
+    '''
+    Read-only gzip file inflated by large blocks with zlib, which is
+    much faster than gzip.GzipFile when it comes to lines. Concatenated
+    members, as written by bgzip or cat, are read one after the other.
+    '''
+    
+    blocksize = 1<<20
+    
+    def __init__(self,file):
+        self.name    = file
+        self._file   = open(file,'rb')
+        self._buffer = b''
+        self._chunks = self._inflate()
+        
+    def _members(self):
+        inflater = zlib.decompressobj(16+zlib.MAX_WBITS)
+        data = self._file.read(self.blocksize)
+        while data:
+            yield inflater.decompress(data)
+            while inflater.unused_data:
+                data = inflater.unused_data
+                inflater = zlib.decompressobj(16+zlib.MAX_WBITS)
+                yield inflater.decompress(data)
+            data = self._file.read(self.blocksize)
+        yield inflater.flush()
+            
+    def _inflate(self):
+        for chunk in self._members():
+            if chunk:
+                yield chunk
+        
+    def _fill(self,size):
+        '''
+        Grow the buffer up to size bytes, or up to the first line end
+        when size is None; False at end of file.
+        '''
+        chunks = [self._buffer]
+        length = len(self._buffer)
+        for chunk in self._chunks:
+            chunks.append(chunk)
+            length += len(chunk)
+            if size is None and b'\n' in chunk:
+                break
+            if size is not None and length >= size:
+                break
+        self._buffer = b''.join(chunks)
+        return len(chunks) > 1
+        
+    def read(self,size=-1):
+        if size < 0:
+            self._fill(sys.maxsize)
+            size = len(self._buffer)
+        elif len(self._buffer) < size:
+            self._fill(size)
+        rep = self._buffer[:size]
+        self._buffer = self._buffer[size:]
+        return rep
+    
+    def readline(self):
+        end = self._buffer.find(b'\n')
+        while end < 0:
+            if not self._fill(None):
+                end = len(self._buffer) - 1
+                break
+            end = self._buffer.find(b'\n')
+        rep = self._buffer[:end+1]
+        self._buffer = self._buffer[end+1:]
+        return rep
+    
+    def __iter__(self):
+        # whole chunks are split into lines at once
+        rest = self._buffer
+        self._buffer = b''
+        for chunk in self._chunks:
+            lines = (rest + chunk).split(b'\n')
+            rest = lines.pop()
+            for line in lines:
+                yield line + b'\n'
+        if rest:
+            yield rest
+            
+    def tell(self):
+        return self._file.tell()
+    
+    def close(self):
+        self._file.close()
+
+def _inflateBgzfBlocks(blocks):
+    return b''.join([zlib.decompress(block[18:-8],-zlib.MAX_WBITS)
+                    for block in blocks])
+        
+class BgzfReader(GzipReader):
+    '''
+    GzipReader for bgzip files. Their blocks are independent gzip
+    members of known size, so they are cut out of the file without
+    inflating them and handed by groups to a pool of jobs processes.
+    '''
+    
+    groupsize = 64
+    
+    def __init__(self,file,jobs):
+        self._pool = multiprocessing.Pool(jobs)
+        GzipReader.__init__(self,file)
+        
+    def _blocks(self):
+        header = self._file.read(18)
+        while header:
+            if not isBgzf(header):
+                raise IOError('%s: not a BGZF block at %d' % 
+                              (self.name,self._file.tell()-len(header)))
+            size = struct.unpack('<H',header[16:18])[0] + 1
+            block = header + self._file.read(size - 18)
+            if len(block) != size:
+                raise IOError('%s: truncated BGZF block' % self.name)
+            yield block
+            header = self._file.read(18)
+            
+    def _groups(self):
+        blocks = self._blocks()
+        group = list(itertools.islice(blocks,self.groupsize))
+        while group:
+            yield group
+            group = list(itertools.islice(blocks,self.groupsize))
+            
+    def _members(self):
+        return self._pool.imap(_inflateBgzfBlocks,self._groups(),4)
+    
+    def close(self):
+        self._pool.terminate()
+        self._pool.join()
+        GzipReader.close(self)
+
+#####
+#
+#
+# Build statistics
+#
+#
+#####
+
+def maxRssKb(who=resource.RUSAGE_SELF):
+    '''
+    Peak resident set size in kB; getrusage gives it in bytes on macOS
+    and in kB on Linux.
+    '''
+    rss = resource.getrusage(who).ru_maxrss
+    if sys.platform == 'darwin':
+        rss //= 1024
+    return rss
+
+class BuildStats(object):
+    '''
+    Wall-clock time of the successive phases of a build, throughput of
+    every sequence file and peak memory. A phase lasts until the next
+    one starts or end is called.
+    '''
+    
+    def __init__(self):
+        self.start     = time.time()
+        self.phases    = []
+        self.sequences = []
+        self._current  = None
+        
+    def phase(self,name):
+        self.end()
+        self._current = (name,time.time())
+        
+    def end(self):
+        if self._current is not None:
+            name,start = self._current
+            self.phases.append((name,time.time() - start))
+            self._current = None
+            
+    def peakMemory(self):
+        '''
+        Peak resident set size in kB of this process and of the
+        largest of its finished worker processes.
+        '''
+        return (maxRssKb(resource.RUSAGE_SELF),
+                maxRssKb(resource.RUSAGE_CHILDREN))
+        
+    def summary(self,output=sys.stderr):
+        self.end()
+        for name,elapsed in self.phases:
+            output.write("  %-24s %9.3fs\n" % (name,elapsed))
+        for progress in self.sequences:
+            output.write("  %-24s %9d records %9.0f records/s %7.2f MB/s\n" %
+                         (os.path.basename(progress.name)[-24:],
+                          progress.records,progress.recordRate(),
+                          progress.byteRate() / 1e6))
+        output.write("  %-24s %9d kB\n" % ('peak memory',
+                                           max(self.peakMemory())))
+        
+    def report(self):
+        self.end()
+        self_rss,children_rss = self.peakMemory()
+        return {'version'  : 1,
+                'command'  : sys.argv,
+                'started'  : datetime.fromtimestamp(self.start).isoformat(),
+                'seconds'  : time.time() - self.start,
+                'phases'   : [{'name': name, 'seconds': elapsed}
+                              for name,elapsed in self.phases],
+                'sequences': [progress.report() for progress in self.sequences],
+                'peak_rss_kb': {'self': self_rss, 'children': children_rss}}
+    
+    def writeReport(self,file):
+        output = open(file,'w')
+        json.dump(self.report(),output,indent=2,sort_keys=True,
+                  separators=(',',': '))
+        output.write('\n')
+        output.close()
+
+class SeqProgress(object):
+    '''
+    Records and bytes read from one sequence file. The progress line
+    is only drawn on a terminal, at most once per interval seconds;
+    where, when set, gives the position in the file to compare with
+    its size.
+    '''
+    
+    def __init__(self,name,size=None,interval=1.0):
+        self.name     = name
+        self.size     = size
+        self.where    = None
+        self.records  = 0
+        self.skipped  = 0
+        self.outside  = 0
+        self.collapsed= 0
+        self.bytes    = 0
+        self.start    = time.time()
+        self.elapsed  = 0.0
+        self.interval = interval
+        self._shown   = self.start
+        self._tty     = sys.stderr.isatty()
+        
+    def update(self,size,skipped=False,outside=False,collapsed=False):
+        if skipped:
+            self.skipped+=1
+        elif outside:
+            self.outside+=1
+        elif collapsed:
+            self.collapsed+=1
+        else:
+            self.records+=1
+        self.bytes+=size
+        if self._tty and not self.records % 64:
+            now = time.time()
+            if now - self._shown >= self.interval:
+                self._shown = now
+                self.elapsed = now - self.start
+                self.show()
+                
+    def show(self):
+        line = " Read sequences : %d (%.0f records/s, %.2f MB/s)" % \
+               (self.records,self.recordRate(),self.byteRate() / 1e6)
+        if self.size:
+            if self.where is None:
+                done = self.bytes
+            else:
+                done = self.where()
+            line += " %5.1f%%" % (100.0 * done / self.size)
+        sys.stderr.write(line + "\r")
+        
+    def finish(self):
+        self.elapsed = time.time() - self.start
+        if self._tty:
+            sys.stderr.write("\n")
+        
+    def recordRate(self):
+        return self.records / self.elapsed if self.elapsed else 0.0
+    
+    def byteRate(self):
+        return self.bytes / self.elapsed if self.elapsed else 0.0
+    
+    def report(self):
+        return {'name'              : self.name,
+                'records'           : self.records,
+                'skipped'           : self.skipped,
+                'outside_selection' : self.outside,
+                'collapsed'         : self.collapsed,
+                'bytes'             : self.bytes,
+                'seconds'           : self.elapsed,
+                'records_per_second': self.recordRate(),
+                'mb_per_second'     : self.byteRate() / 1e6}
+
+buildStats = BuildStats()
 
 #####
 #
@@ -112,15 +550,15 @@ class ColumnFile(object):
     def __init__(self,stream,sep=None,strip=True,types=None):
         if isinstance(stream,str):
             self._stream = open(stream)
-        elif hasattr(stream,'next'):
+        elif hasattr(stream,'__next__'):
             self._stream = stream
         else:
-            raise ValueError,'stream must be string or an iterator'
+            raise ValueError('stream must be string or an iterator')
         self._delimiter=sep
         self._strip=strip
         if types:
             self._types=[x for x in types]
-            for i in xrange(len(self._types)):
+            for i in range(len(self._types)):
                 if self._types[i] is bool:
                     self._types[i]=ColumnFile.str2bool
         else:
@@ -135,124 +573,971 @@ class ColumnFile(object):
     def __iter__(self):
         return self
     
-    def next(self):
-        line = self._stream.next()
+    def __next__(self):
+        line = next(self._stream)
         data = line.split(self._delimiter)
         if self._strip or self._types:
             data = [x.strip() for x in data]
         if self._types:
             it = endLessIterator(self._types)
-            data = [x[1](x[0]) for x in ((y,it.next()) for y in data)]
+            data = [x[1](x[0]) for x in ((y,next(it)) for y in data)]
         return data
     
-def taxonCmp(t1,t2):
-    if t1[0] < t2[0]:
-        return -1
-    elif t1[0] > t2[0]:
-        return +1
-    return 0
+_dmpFieldEnd = b'\t|\t'
+_dmpLineEnd  = b'\t|\n'
 
-def bsearchTaxon(taxonomy,taxid):
-    taxCount = len(taxonomy)
-    begin = 0
-    end   = taxCount 
-    oldcheck=taxCount
-    check = begin + end / 2
-    while check != oldcheck and taxonomy[check][0]!=taxid :
-        if taxonomy[check][0] < taxid:
-            begin=check
+def dmpColumnChunks(file,columns,types,chunksize=1<<22):
+    '''
+    Read an NCBI taxdump *.dmp file by large chunks and yield, for each
+    chunk, one list per requested column. A whole chunk is split on the
+    field delimiter at once, the requested columns are then taken with
+    extended slices and converted with map, so no Python code runs per
+    field.
+    '''
+    file = universalOpen(file)
+    ncols = None
+    rest  = b''
+    eof   = False
+    while not eof:
+        chunk = file.read(chunksize)
+        if chunk:
+            chunk = rest + chunk
+            end = chunk.rfind(_dmpLineEnd)
+            if end < 0:
+                rest = chunk
+                continue
+            end += len(_dmpLineEnd)
+            rest  = chunk[end:]
+            chunk = chunk[:end]
         else:
-            end=check
-        oldcheck=check
-        check = (begin + end) / 2
+            eof = True
+            if not rest.strip():
+                break
+            chunk = rest.rstrip(b'\n')
+            if not chunk.endswith(b'\t|'):
+                raise ValueError('truncated line in taxdump file: %r' % chunk[-80:])
+            chunk += b'\n'
+            
+        if ncols is None:
+            ncols = chunk.count(_dmpFieldEnd,0,chunk.index(_dmpLineEnd)) + 1
+            
+        fields = chunk.replace(_dmpLineEnd,_dmpFieldEnd).split(_dmpFieldEnd)
+        fields.pop()
+        if len(fields) % ncols:
+            raise ValueError('taxdump lines do not all have %d columns' % ncols)
         
+        data = []
+        for column,convert in zip(columns,types):
+            values = fields[column::ncols]
+            if convert is not bytes:
+                values = list(map(convert,values))
+            data.append(values)
+        yield data
         
-    if taxonomy[check][0]==taxid:
-        return check
-    else:
-        return None
+def dmpRowIterator(file,columns,types):
+    for data in dmpColumnChunks(file,columns,types):
+        for row in zip(*data):
+            yield row
+            
+class TaxonIndex(object):
+    '''
+    Dense taxid -> taxonomy row index backed by an array('i').
+    Unknown taxids raise KeyError and deleted taxids map to None,
+    like the dict it replaces.
+    '''
+    
+    UNKNOWN = -1
+    DELETED = -2
+    
+    def __init__(self,size=0,rows=None):
+        if rows is None:
+            rows = array('i',[TaxonIndex.UNKNOWN]) * size
+        self._rows = rows
+        
+    def __getitem__(self,taxid):
+        if taxid < 0 or taxid >= len(self._rows):
+            raise KeyError(taxid)
+        row = self._rows[taxid]
+        if row < 0:
+            if row == TaxonIndex.DELETED:
+                return None
+            raise KeyError(taxid)
+        return row
+    
+    def __setitem__(self,taxid,row):
+        if taxid >= len(self._rows):
+            self._rows.extend(array('i',[TaxonIndex.UNKNOWN]) * 
+                              (taxid + 1 - len(self._rows)))
+        if row is None:
+            row = TaxonIndex.DELETED
+        self._rows[taxid] = row
         
+    def __contains__(self,taxid):
+        return 0 <= taxid < len(self._rows) and \
+               self._rows[taxid] != TaxonIndex.UNKNOWN
+               
+    def get(self,taxid,default=None):
+        try:
+            return self[taxid]
+        except KeyError:
+            return default
     
+class StringBlob(object):
+    '''
+    Strings stored end to end in a single bytearray and addressed
+    by their number; string i spans offsets[i]:offsets[i+1].
+    '''
+    
+    def __init__(self,data=None,offsets=None):
+        if data is None:
+            data = bytearray()
+            offsets = array('l',[0])
+        self._data    = data
+        self._offsets = offsets
+        
+    def __len__(self):
+        return len(self._offsets) - 1
     
+    def __getitem__(self,i):
+        return bytes(self._data[self._offsets[i]:self._offsets[i+1]])
+    
+    def append(self,string):
+        self._data += string
+        self._offsets.append(len(self._data))
+        return len(self._offsets) - 2
+    
+class Taxonomy(object):
+    '''
+    Struct-of-arrays taxonomy table. Row i is the taxon
+    (taxids[i], rankcodes[i], parents[i], strings[names[i]]),
+    which is what ecoTaxPacker expects.
+    '''
+    
+    def __init__(self,taxids,rankcodes,parents,names,strings):
+        self.taxids    = taxids
+        self.rankcodes = rankcodes
+        self.parents   = parents
+        self.names     = names
+        self.strings   = strings
+        
+    def __len__(self):
+        return len(self.taxids)
+    
+    def __getitem__(self,row):
+        name = self.names[row]
+        if name < 0:
+            name = b''
+        else:
+            name = self.strings[name]
+        return (self.taxids[row],self.rankcodes[row],self.parents[row],name)
+    
+    def __iter__(self):
+        for row in range(len(self.taxids)):
+            yield self[row]
+            
+class NameTable(object):
+    '''
+    Struct-of-arrays list of (name, classname, taxon row) tuples.
+    Names live in a StringBlob shared with the Taxonomy, class names
+    are stored once and referenced by a one byte code.
+    '''
+    
+    def __init__(self,strings,names=None,classes=None,taxa=None,
+                 classNames=None,byName=False):
+        if names is None:
+            names   = array('i')
+            classes = array('B')
+            taxa    = array('i')
+            classNames = []
+        self.strings    = strings
+        self.names      = names
+        self.classes    = classes
+        self.taxa       = taxa
+        self.classNames = classNames
+        # True once sorted by sortByName and left untouched since
+        self.byName     = byName
+        self._classCodes = dict((c,i) for i,c in enumerate(classNames))
+        
+    def __len__(self):
+        return len(self.names)
+    
+    def __getitem__(self,i):
+        return (self.strings[self.names[i]],
+                self.classNames[self.classes[i]],
+                self.taxa[i])
+        
+    def __iter__(self):
+        for i in range(len(self.names)):
+            yield self[i]
+            
+    def append(self,name,classname,taxon):
+        '''
+        Add a name and return its string number.
+        '''
+        code = self._classCodes.get(classname)
+        if code is None:
+            code = len(self.classNames)
+            self.classNames.append(classname)
+            self._classCodes[classname]=code
+        nameid = self.strings.append(name)
+        self.names.append(nameid)
+        self.classes.append(code)
+        self.taxa.append(taxon)
+        self.byName = False
+        return nameid
+    
+    def sort(self,key=None):
+        if key is None:
+            key = self.__getitem__
+        else:
+            key = lambda i,key=key: key(self[i])
+        self.reorder(sorted(range(len(self.names)),key=key))
+        
+    def reorder(self,order):
+        self.names   = array('i',(self.names[i] for i in order))
+        self.classes = array('B',(self.classes[i] for i in order))
+        self.taxa    = array('i',(self.taxa[i] for i in order))
+        self.byName  = False
+        
+    def sortByName(self):
+        '''
+        Sort in the order of nameCmp, which ecoPrimers expects, with
+        each upper-cased name computed once instead of at every
+        comparison. Both sorts are stable, so ties keep their order.
+        Upper-casing bytes only maps ASCII letters, one byte at a time,
+        so the whole StringBlob is upper-cased in one go.
+        '''
+        if self.byName:
+            return
+        upper   = bytes(self.strings._data).upper()
+        offsets = self.strings._offsets
+        keys = [upper[offsets[n]:offsets[n+1]] for n in self.names]
+        self.reorder(sorted(range(len(keys)),key=keys.__getitem__))
+        self.byName = True
+        
 def readNodeTable(file):
 
-    file = universalOpen(file)
-    
-    nodes = ColumnFile(file, 
-                       sep='|', 
-                       types=(int,int,str,
-                              str,str,bool,
-                              int,bool,int,
-                              bool,bool,bool,str))
     sys.stderr.write("Reading taxonomy dump file...\n")
-    taxonomy=[[n[0],n[2],n[1]] for n in nodes]
-    sys.stderr.write("List all taxonomy rank...\n")    
-    ranks =list(set(x[1] for x in taxonomy))
-    ranks.sort()
-    ranks = dict(map(None,ranks,xrange(len(ranks))))
+    buildStats.phase('nodes: read')
+    taxids   = array('i')
+    parents  = array('i')
+    rankcodes= array('i')
+    rankcode = {}
+    for taxid,parent,rank in dmpColumnChunks(file,(0,1,2),(int,int,bytes.strip)):
+        for r in set(rank):
+            rankcode.setdefault(r,len(rankcode))
+        taxids.extend(taxid)
+        parents.extend(parent)
+        rankcodes.extend(map(rankcode.__getitem__,rank))
+        
+    sys.stderr.write("List all taxonomy rank...\n")
+    buildStats.phase('nodes: ranks')
+    ranks = sorted(rankcode)
+    ranks = dict(zip(ranks,range(len(ranks))))
+    recode = [0] * len(rankcode)
+    for rank,code in rankcode.items():
+        recode[code]=ranks[rank]
     
+    # taxids are unique small integers, so sorting is a counting sort
+    # through the dense index: store each taxon's input position, then
+    # walk the taxids in increasing order.
     sys.stderr.write("Sorting taxons...\n")
-    taxonomy.sort(taxonCmp)
+    buildStats.phase('nodes: sort')
+    index = TaxonIndex(max(taxids) + 1)
+    rows  = index._rows
+    for position in range(len(taxids)):
+        rows[taxids[position]]=position
 
     sys.stderr.write("Indexing taxonomy...\n")
-    index = {}
-    for t in taxonomy:
-        index[t[0]]=bsearchTaxon(taxonomy, t[0])
+    buildStats.phase('nodes: index')
+    sortedTaxids  = array('i')
+    sortedParents = array('i')
+    sortedRanks   = array('i')
+    row = 0
+    for taxid in range(len(rows)):
+        position = rows[taxid]
+        if position >= 0:
+            sortedTaxids.append(taxid)
+            sortedParents.append(parents[position])
+            sortedRanks.append(recode[rankcodes[position]])
+            rows[taxid]=row
+            row+=1
+    del taxids,parents,rankcodes
     
     sys.stderr.write("Indexing parent and rank...\n")
-    for t in taxonomy:
-        t[1]=ranks[t[1]]
-        t[2]=index[t[2]]
+    buildStats.phase('nodes: parents')
+    for row in range(len(sortedParents)):
+        sortedParents[row]=rows[sortedParents[row]]
         
+    taxonomy = Taxonomy(sortedTaxids,
+                        sortedRanks,
+                        sortedParents,
+                        array('i',[-1]) * len(sortedTaxids),
+                        StringBlob())
         
     return taxonomy,ranks,index
 
 def nameIterator(file):
-    file = universalOpen(file)
-    names = ColumnFile(file, 
-                       sep='|', 
-                       types=(int,str,
-                              str,str))
-    for taxid,name,unique,classname,white in names:
-        yield taxid,name,classname
+    return dmpRowIterator(file,(0,1,3),(int,bytes.strip,bytes.strip))
         
 def mergedNodeIterator(file):
-    file = universalOpen(file)
-    merged = ColumnFile(file, 
-                       sep='|', 
-                       types=(int,int,str))
-    for taxid,current,white in merged:
-            yield taxid,current
+    return dmpRowIterator(file,(0,1),(int,int))
     
 def deletedNodeIterator(file):
-    file = universalOpen(file)
-    deleted = ColumnFile(file, 
-                       sep='|', 
-                       types=(int,str))
-    for taxid,white in deleted:
+    for data in dmpColumnChunks(file,(0,),(int,)):
+        for taxid in data[0]:
             yield taxid
     
+def isTaxdumpArchive(taxdir):
+    return os.path.isfile(taxdir) and taxdir.endswith(('.tar.gz','.tgz'))
+
+def taxdumpPath(taxdir,name):
+    '''
+    The file holding a dump file of a taxdump folder: name itself, or
+    name.gz when only the compressed one is there.
+    '''
+    path = '%s/%s' % (taxdir,name)
+    if not os.path.exists(path) and os.path.exists(path + '.gz'):
+        path += '.gz'
+    return path
+
+def taxdumpFiles(taxdir,names):
+    '''
+    Yield the dump files called names of taxdir, in that order, each
+    to be read through before the next one is asked for. taxdir is
+    either a folder or the taxdump.tar.gz archive, which is then read
+    once, in the order of its members, without being unpacked: the
+    members found before their turn are copied to temporary files.
+    '''
+    if not isTaxdumpArchive(taxdir):
+        for name in names:
+            file = universalOpen(taxdumpPath(taxdir,name))
+            try:
+                yield file
+            finally:
+                file.close()
+        return
+    
+    wanted  = list(names)
+    spooled = {}
+    archive = tarfile.open(taxdir,'r|gz')
+    try:
+        for member in archive:
+            name = os.path.basename(member.name)
+            if name not in wanted or name in spooled:
+                continue
+            if name != wanted[0]:
+                spooled[name] = tempfile.TemporaryFile()
+                shutil.copyfileobj(archive.extractfile(member),spooled[name])
+                spooled[name].seek(0)
+                continue
+            yield archive.extractfile(member)
+            wanted.pop(0)
+            while wanted and wanted[0] in spooled:
+                file = spooled.pop(wanted.pop(0))
+                try:
+                    yield file
+                finally:
+                    file.close()
+            if not wanted:
+                break
+        if wanted:
+            raise IOError('no %s in %s' % (wanted[0],taxdir))
+    finally:
+        for file in spooled.values():
+            file.close()
+        archive.close()
+
 def readTaxonomyDump(taxdir):
-    taxonomy,ranks,index = readNodeTable('%s/nodes.dmp' % taxdir)
+    dumps = taxdumpFiles(taxdir,_taxdumpFiles)
+    try:
+        return _readDumpFiles(dumps)
+    finally:
+        dumps.close()
+        
+def _readDumpFiles(dumps):
+    taxonomy,ranks,index = readNodeTable(next(dumps))
     
     sys.stderr.write("Adding scientific name...\n")
+    buildStats.phase('names')
 
-    alternativeName=[]
-    for taxid,name,classname in nameIterator('%s/names.dmp' % taxdir):
-        alternativeName.append((name,classname,index[taxid]))
-        if classname == 'scientific name':
-            taxonomy[index[taxid]].append(name)
+    alternativeName=NameTable(taxonomy.strings)
+    names = taxonomy.names
+    for taxid,name,classname in nameIterator(next(dumps)):
+        row = index[taxid]
+        nameid = alternativeName.append(name,classname,row)
+        if classname == b'scientific name' and names[row] < 0:
+            names[row]=nameid
         
     sys.stderr.write("Adding taxid alias...\n")
-    for taxid,current in mergedNodeIterator('%s/merged.dmp' % taxdir):
+    buildStats.phase('merged')
+    for taxid,current in mergedNodeIterator(next(dumps)):
         index[taxid]=index[current]
     
     sys.stderr.write("Adding deleted taxid...\n")
-    for taxid in deletedNodeIterator('%s/delnodes.dmp' % taxdir):
+    buildStats.phase('deleted')
+    for taxid in deletedNodeIterator(next(dumps)):
         index[taxid]=None
+    buildStats.end()
     
     return taxonomy,ranks,alternativeName,index
 
+#####
+#
+#
+# Compiled taxonomy cache
+#
+#
+#####
+
+TAXONOMY_CACHE_MAGIC   = b'ECOTAXC\0'
+TAXONOMY_CACHE_VERSION = 5
+
+_taxdumpFiles = ('nodes.dmp','names.dmp','merged.dmp','delnodes.dmp')
+
+def fileChecksum(file, blocksize=1<<20):
+    digest = hashlib.md5()
+    f = open(file,'rb')
+    block = f.read(blocksize)
+    while block:
+        digest.update(block)
+        block = f.read(blocksize)
+    f.close()
+    return digest.hexdigest()
+
+def taxdumpSources(taxdir):
+    '''
+    The files a taxonomy is read from: the archive, or the dump files
+    of the folder.
+    '''
+    if isTaxdumpArchive(taxdir):
+        return [taxdir]
+    return [taxdumpPath(taxdir,name) for name in _taxdumpFiles]
+
+def taxdumpSignature(taxdir, checksum=True):
+    '''
+    Describe the taxdump files as a list of (name, size, mtime, md5).
+    The md5 is left to None when checksum is False.
+    '''
+    signature = []
+    for path in taxdumpSources(taxdir):
+        name = os.path.basename(path)
+        st = os.stat(path)
+        if checksum:
+            md5 = fileChecksum(path)
+        else:
+            md5 = None
+        signature.append((name,st.st_size,int(st.st_mtime),md5))
+    return signature
+
+def sameTaxdump(taxdir, signature):
+    '''
+    True when the taxdump files still match a signature. Sizes and mtimes
+    are checked first; checksums are only recomputed when an mtime moved,
+    so touching the files does not invalidate the cache.
+    '''
+    try:
+        current = taxdumpSignature(taxdir, checksum=False)
+    except OSError:
+        return False
+    if len(current) != len(signature):
+        return False
+    for path,(name,size,mtime,md5),old in zip(taxdumpSources(taxdir),
+                                              current,signature):
+        if name != old[0] or size != old[1]:
+            return False
+        if mtime != old[2] and fileChecksum(path) != old[3]:
+            return False
+    return True
+
+def defaultTaxonomyCache(taxdir):
+    if isTaxdumpArchive(taxdir):
+        return '%s.ecocache' % re.sub(r'\.(tar\.gz|tgz)$','',taxdir)
+    return '%s/taxonomy.ecocache' % taxdir
+
+def readTaxonomyCache(file, taxdir):
+    '''
+    Return the cached taxonomy of taxdir, or None when the cache
+    is missing, of another version or out of date.
+    '''
+    try:
+        cache = open(file,'rb')
+    except IOError:
+        return None
+    try:
+        if cache.read(len(TAXONOMY_CACHE_MAGIC)) != TAXONOMY_CACHE_MAGIC:
+            return None
+        header = marshal.load(cache)
+        if header.get('version') != TAXONOMY_CACHE_VERSION:
+            return None
+        if not sameTaxdump(taxdir, header['signature']):
+            return None
+        layout = marshal.load(cache)
+        columns = {}
+        for name,typecode,count in layout['arrays']:
+            columns[name] = array(typecode)
+            columns[name].fromfile(cache,count)
+        blob = bytearray(cache.read(layout['blob']))
+    except (EOFError,ValueError,TypeError,KeyError):
+        return None
+    finally:
+        cache.close()
+    if len(blob) != layout['blob']:
+        return None
+    
+    strings  = StringBlob(blob,columns['offsets'])
+    taxonomy = Taxonomy(columns['taxids'],
+                        columns['rankcodes'],
+                        columns['parents'],
+                        columns['scientific'],
+                        strings)
+    alternativeName = NameTable(strings,
+                                columns['names'],
+                                columns['classes'],
+                                columns['taxa'],
+                                layout['classNames'],
+                                layout['namesByName'])
+    index = TaxonIndex(rows=columns['index'])
+    return taxonomy,layout['ranks'],alternativeName,index
+
+def writeTaxonomyCache(file, taxdir, taxonomy):
+    '''
+    The cache is a marshalled header and layout followed by the raw
+    content of every array, so that loading is a handful of fromfile.
+    '''
+    taxonomy,ranks,alternativeName,index = taxonomy
+    header = {'version'  : TAXONOMY_CACHE_VERSION,
+              'signature': taxdumpSignature(taxdir)}
+    columns = [('taxids'    , taxonomy.taxids),
+               ('rankcodes' , taxonomy.rankcodes),
+               ('parents'   , taxonomy.parents),
+               ('scientific', taxonomy.names),
+               ('offsets'   , taxonomy.strings._offsets),
+               ('names'     , alternativeName.names),
+               ('classes'   , alternativeName.classes),
+               ('taxa'      , alternativeName.taxa),
+               ('index'     , index._rows)]
+    layout = {'ranks'     : ranks,
+              'classNames': alternativeName.classNames,
+              'namesByName': alternativeName.byName,
+              'arrays'    : [(name,a.typecode,len(a)) for name,a in columns],
+              'blob'      : len(taxonomy.strings._data)}
+    tmp = '%s.%d.tmp' % (file,os.getpid())
+    output = open(tmp,'wb')
+    try:
+        output.write(TAXONOMY_CACHE_MAGIC)
+        marshal.dump(header, output)
+        marshal.dump(layout, output)
+        for name,a in columns:
+            a.tofile(output)
+        output.write(taxonomy.strings._data)
+    finally:
+        output.close()
+    os.rename(tmp, file)
+
+def cachedTaxonomyDump(taxdir, cachefile=None):
+    '''
+    Same as readTaxonomyDump, but go through a compiled cache that is
+    rebuilt whenever the taxdump files change.
+    '''
+    if cachefile is None:
+        cachefile = defaultTaxonomyCache(taxdir)
+        
+    buildStats.phase('taxonomy cache: read')
+    taxonomy = readTaxonomyCache(cachefile, taxdir)
+    buildStats.end()
+    if taxonomy is not None:
+        sys.stderr.write("Taxonomy loaded from cache %s\n" % cachefile)
+        return taxonomy
+    
+    taxonomy = readTaxonomyDump(taxdir)
+    
+    # sorted before caching, so the order is reused with the cache
+    buildStats.phase('names: sort')
+    taxonomy[2].sortByName()
+    
+    sys.stderr.write("Writing taxonomy cache %s...\n" % cachefile)
+    buildStats.phase('taxonomy cache: write')
+    try:
+        writeTaxonomyCache(cachefile, taxdir, taxonomy)
+    except OSError as e:
+        sys.stderr.write("Could not write taxonomy cache: %s\n" % e)
+    buildStats.end()
+    return taxonomy
+
+#####
+#
+#
+# Taxon selection
+#
+#
+#####
+
+def childIndex(parents):
+    '''
+    Children of every row of a parent column, end to end, through a
+    counting sort: the children of row r are children[start[r]:start[r+1]].
+    Return (start, children, roots); roots are their own parent.
+    '''
+    size = len(parents)
+    start = array('i',[0]) * (size + 1)
+    roots = []
+    for row in range(size):
+        parent = parents[row]
+        if parent == row or parent < 0:
+            roots.append(row)
+        else:
+            start[parent + 1]+=1
+    for row in range(size):
+        start[row + 1]+=start[row]
+    fill = array('i',start)
+    children = array('i',[0]) * start[size]
+    for row in range(size):
+        parent = parents[row]
+        if parent != row and parent >= 0:
+            children[fill[parent]]=row
+            fill[parent]+=1
+    return start,children,roots
+
+def preorderIntervals(parents):
+    '''
+    Number the rows of a parent column in depth-first preorder. Return
+    (enter, leave, order): the subtree of row r is made of the rows s
+    with enter[r] <= enter[s] < leave[r], and order[i] is the row
+    numbered i. Rows that no root reaches keep an enter of -1.
+    '''
+    size = len(parents)
+    start,children,roots = childIndex(parents)
+    enter = array('i',[-1]) * size
+    order = array('i')
+    for root in roots:
+        stack = [root]
+        while stack:
+            row = stack.pop()
+            enter[row]=len(order)
+            order.append(row)
+            stack.extend(children[start[row]:start[row + 1]])
+    
+    # subtree sizes, children before parents
+    leave = array('i',[1]) * size
+    for position in range(len(order) - 1,-1,-1):
+        row = order[position]
+        parent = parents[row]
+        if parent != row and parent >= 0:
+            leave[parent]+=leave[row]
+    for row in range(size):
+        leave[row]+=enter[row]
+    return enter,leave,order
+
+class TaxonSelection(object):
+    '''
+    The taxa under the include taxids (all taxa when there are none)
+    and not under the exclude taxids, tested in constant time through
+    preorder intervals. With prune, taxonomy is the taxonomy cut down
+    to the selected taxa and their ancestors, and row() translates
+    rows of the full taxonomy to rows of the pruned one.
+    '''
+    
+    def __init__(self,taxonomy,include=(),exclude=(),prune=False):
+        self.include = sorted(set(include))
+        self.exclude = sorted(set(exclude))
+        self.prune   = prune
+        table,ranks,names,index = taxonomy
+        
+        sys.stderr.write("Selecting taxa...\n")
+        buildStats.phase('taxa: select')
+        self._enter,leave,order = preorderIntervals(table.parents)
+        if self.include:
+            inside = bytearray(len(order))
+        else:
+            inside = bytearray(b'\1') * len(order)
+        for taxids,flag in ((self.include,b'\1'),(self.exclude,b'\0')):
+            for taxid in taxids:
+                row = index.get(taxid)
+                if row is None or self._enter[row] < 0:
+                    raise ValueError('taxid %d is not in the taxonomy' % taxid)
+                first,last = self._enter[row],leave[row]
+                inside[first:last] = flag * (last - first)
+        self._inside = inside
+        
+        self.taxonomy = taxonomy
+        self._rows = None
+        if prune:
+            buildStats.phase('taxa: prune')
+            keep = bytearray(len(table))
+            for position,row in enumerate(order):
+                keep[row] = inside[position]
+            # the lineage of every selected taxon
+            parents = table.parents
+            for row in order:
+                if keep[row]:
+                    parent = parents[row]
+                    while not keep[parent]:
+                        keep[parent] = 1
+                        parent = parents[parent]
+            self.taxonomy,self._rows = pruneTaxonomy(taxonomy,keep)
+        buildStats.end()
+        
+    def __contains__(self,row):
+        position = self._enter[row]
+        return position >= 0 and self._inside[position] == 1
+    
+    def row(self,row):
+        '''
+        Row of a selected taxon in self.taxonomy, or None.
+        '''
+        if row not in self:
+            return None
+        if self._rows is None:
+            return row
+        return self._rows[row]
+    
+    def key(self):
+        '''
+        What a database built through this selection depends on.
+        '''
+        return (self.include,self.exclude,self.prune)
+    
+def pruneTaxonomy(taxonomy,keep):
+    '''
+    The taxonomy restricted to the rows set in keep, which must hold
+    the parent of every kept row, and the array giving the new row of
+    every old one (-1 when dropped). Rows keep their taxid order.
+    '''
+    table,ranks,names,index = taxonomy
+    rows = array('i',[-1]) * len(table)
+    taxids    = array('i')
+    rankcodes = array('i')
+    parents   = array('i')
+    scientific= array('i')
+    for row in range(len(table)):
+        if keep[row]:
+            rows[row]=len(taxids)
+            taxids.append(table.taxids[row])
+            rankcodes.append(table.rankcodes[row])
+            parents.append(table.parents[row])
+            scientific.append(table.names[row])
+    for row in range(len(parents)):
+        parents[row]=rows[parents[row]]
+    pruned = Taxonomy(taxids,rankcodes,parents,scientific,table.strings)
+    
+    # filtering keeps the name order, sorted or not
+    prunedNames = NameTable(names.strings,array('i'),array('B'),array('i'),
+                            names.classNames,names.byName)
+    for name,code,taxon in zip(names.names,names.classes,names.taxa):
+        taxon = rows[taxon]
+        if taxon >= 0:
+            prunedNames.names.append(name)
+            prunedNames.classes.append(code)
+            prunedNames.taxa.append(taxon)
+    
+    indexRows = array('i',index._rows)
+    for taxid in range(len(indexRows)):
+        row = indexRows[taxid]
+        if row >= 0:
+            row = rows[row]
+            if row < 0:
+                row = TaxonIndex.UNKNOWN
+            indexRows[taxid]=row
+    return (pruned,ranks,prunedNames,TaxonIndex(rows=indexRows)),rows
+
+#####
+#
+#
+# Lineage index
+#
+#
+#####
+
+class LineageIndex(object):
+    '''
+    Constant-time lineage queries over a taxonomy as returned by
+    readTaxonomyDump: ancestry, lowest common ancestor and ancestor at
+    a rank. Queries take NCBI taxids (merged ones included) and answer
+    with taxids, or None.
+    
+    The Euler tour of the tree lists every row when entered and again
+    after each of its children, packed as depth << 32 | row, so the
+    smallest value between the first visits of two rows is their LCA.
+    Range minima come from a sparse table over blocks of 32 values;
+    the ends of a range are scanned within their blocks. Ancestors at
+    a rank are arrays filled in preorder, one per rank asked for.
+    '''
+    
+    BLOCK = 5   # log2 of the block size
+    
+    def __init__(self,taxonomy):
+        self.taxonomy,self.ranks,names,self.index = taxonomy
+        
+        sys.stderr.write("Indexing lineages...\n")
+        buildStats.phase('lineage index')
+        table = self.taxonomy
+        size  = len(table)
+        start,children,roots = childIndex(table.parents)
+        nextChild = array('i',start)
+        depth = array('i',[0]) * size
+        first = array('i',[-1]) * size
+        last  = array('i',[-1]) * size
+        tour  = array('q')
+        order = array('i')
+        for root in roots:
+            first[root] = len(tour)
+            tour.append(root)
+            order.append(root)
+            stack = [root]
+            while stack:
+                row = stack[-1]
+                if nextChild[row] < start[row + 1]:
+                    child = children[nextChild[row]]
+                    nextChild[row]+=1
+                    depth[child] = depth[row] + 1
+                    first[child] = len(tour)
+                    tour.append(depth[child] << 32 | child)
+                    order.append(child)
+                    stack.append(child)
+                else:
+                    last[row] = len(tour) - 1
+                    stack.pop()
+                    if stack:
+                        parent = stack[-1]
+                        tour.append(depth[parent] << 32 | parent)
+        del nextChild,children,start
+        
+        width = 1 << LineageIndex.BLOCK
+        levels = [array('q',[min(tour[i:i + width]) 
+                             for i in range(0,len(tour),width)])]
+        span = 1
+        while 2 * span <= len(levels[0]):
+            previous = levels[-1]
+            levels.append(array('q',map(min,previous[:-span],
+                                        previous[span:])))
+            span*=2
+        
+        self.depth  = depth
+        self._first = first
+        self._last  = last
+        self._tour  = tour
+        self._order = order
+        self._levels= levels
+        self._atRank= {}
+        buildStats.end()
+        
+    def row(self,taxid):
+        '''
+        Row of a taxid, or None when it is missing, unknown or deleted.
+        '''
+        if taxid is None:
+            return None
+        return self.index.get(taxid)
+    
+    def isAncestorRow(self,ancestor,row):
+        '''
+        True when row is ancestor or lies under it.
+        '''
+        return self._first[ancestor] <= self._first[row] <= self._last[ancestor]
+    
+    def isUnder(self,taxid,ancestor):
+        row,ancestor = self.row(taxid),self.row(ancestor)
+        if row is None or ancestor is None:
+            return False
+        return self.isAncestorRow(ancestor,row)
+    
+    def lcaRow(self,row1,row2):
+        '''
+        Lowest common ancestor of two rows, or None when they are in
+        different trees.
+        '''
+        left,right = self._first[row1],self._first[row2]
+        if left > right:
+            left,right = right,left
+        tour  = self._tour
+        block = LineageIndex.BLOCK
+        leftBlock,rightBlock = left >> block,right >> block
+        if leftBlock == rightBlock:
+            best = min(tour[left:right + 1])
+        else:
+            best = min(min(tour[left:(leftBlock + 1) << block]),
+                       min(tour[rightBlock << block:right + 1]))
+            if leftBlock + 1 < rightBlock:
+                level = (rightBlock - leftBlock - 1).bit_length() - 1
+                minima = self._levels[level]
+                best = min(best,minima[leftBlock + 1],
+                           minima[rightBlock - (1 << level)])
+        row = best & 0xffffffff
+        if not (self.isAncestorRow(row,row1) and self.isAncestorRow(row,row2)):
+            return None
+        return row
+    
+    def lca(self,*taxids):
+        '''
+        Lowest common ancestor of one or more taxids.
+        '''
+        rows = [self.row(taxid) for taxid in taxids]
+        if None in rows:
+            return None
+        row = rows[0]
+        for other in rows[1:]:
+            row = self.lcaRow(row,other)
+            if row is None:
+                return None
+        return self.taxonomy.taxids[row]
+    
+    def rankRows(self,rank):
+        '''
+        For every row, the row of its closest ancestor (itself
+        included) of the given rank, or -1.
+        '''
+        if isinstance(rank,str):
+            rank = rank.encode()
+        rows = self._atRank.get(rank)
+        if rows is None:
+            rows = array('i',[-1]) * len(self.taxonomy)
+            code = self.ranks.get(rank)
+            if code is not None:
+                rankcodes = self.taxonomy.rankcodes
+                parents = self.taxonomy.parents
+                # parents come before their children in preorder
+                for row in self._order:
+                    if rankcodes[row] == code:
+                        rows[row] = row
+                    else:
+                        parent = parents[row]
+                        if parent != row:
+                            rows[row] = rows[parent]
+            self._atRank[rank] = rows
+        return rows
+    
+    def ancestorAt(self,taxid,rank):
+        '''
+        The taxid of rank above taxid (or taxid itself), or None.
+        '''
+        return self.ancestorsAt([taxid],rank)[0]
+    
+    def ancestorsAt(self,taxids,rank):
+        '''
+        ancestorAt for a whole batch of taxids.
+        '''
+        rows = self.rankRows(rank)
+        get = self.index.get
+        found = []
+        append = found.append
+        for taxid in taxids:
+            row = get(taxid) if taxid is not None else None
+            if row is not None:
+                row = rows[row]
+            append(None if row is None or row < 0 
+                   else self.taxonomy.taxids[row])
+        return found
+    
+    def name(self,taxid):
+        '''
+        Scientific name of a taxid, or None.
+        '''
+        row = self.row(taxid)
+        if row is None:
+            return None
+        return self.taxonomy[row][3]
+
 #####
 #
 #
@@ -266,61 +1551,216 @@ def entryIterator(file):
     rep =[]
     for line in file:
         rep.append(line)
-        if line == '//\n':
-            rep = ''.join(rep)
+        if line == b'//\n':
+            rep = b''.join(rep)
             yield rep
             rep = []
-            
+
+ENTRY_INDEX_MAGIC   = b'ECOIDX\0\0'
+ENTRY_INDEX_VERSION = 1
+
+def entryIndexName(file):
+    return '%s.ecoidx' % file
+
+def readEntryIndex(file):
+    '''
+    Return the saved record offsets of file, or None when there is
+    no index or the file changed since it was written.
+    '''
+    try:
+        index = open(entryIndexName(file),'rb')
+    except IOError:
+        return None
+    try:
+        if index.read(len(ENTRY_INDEX_MAGIC)) != ENTRY_INDEX_MAGIC:
+            return None
+        header = marshal.load(index)
+        st = os.stat(file)
+        if (header.get('version') != ENTRY_INDEX_VERSION or
+            header['size'] != st.st_size or 
+            header['mtime'] != int(st.st_mtime)):
+            return None
+        offsets = array('l')
+        offsets.fromfile(index,header['count'])
+    except (EOFError,ValueError,TypeError,KeyError,OSError):
+        return None
+    finally:
+        index.close()
+    return offsets
+
+def writeEntryIndex(file,offsets):
+    st = os.stat(file)
+    header = {'version': ENTRY_INDEX_VERSION,
+              'size'   : st.st_size,
+              'mtime'  : int(st.st_mtime),
+              'count'  : len(offsets)}
+    name = entryIndexName(file)
+    tmp  = '%s.%d.tmp' % (name,os.getpid())
+    output = open(tmp,'wb')
+    try:
+        output.write(ENTRY_INDEX_MAGIC)
+        marshal.dump(header,output)
+        offsets.tofile(output)
+    finally:
+        output.close()
+    os.rename(tmp,name)
+
+def entryOffsetIterator(data):
+    '''
+    Yield the start of every '//' terminated record of a mapped file,
+    then the end of the last one. Records are cut exactly where
+    entryIterator cuts them.
+    '''
+    yield 0
+    if data[:3] == b'//\n':
+        yield 3
+    end = data.find(b'\n//\n')
+    while end >= 0:
+        yield end + 4
+        end = data.find(b'\n//\n',end + 3)
+
+def mmapEntryIterator(file,index=False,start=0,stop=None):
+    '''
+    Same records as entryIterator, but sliced out of a memory map of
+    the file instead of being assembled line by line. With index, the
+    record offsets are saved beside the input and reused as long as it
+    does not change. start and stop select a range of record numbers.
+    Compressed files are cut by large reads with streamEntryIterator
+    and pipes are handed to entryIterator.
+    '''
+    file = universalOpen(file)
+    if isinstance(file,(gzip.GzipFile,GzipReader)):
+        return itertools.islice(streamEntryIterator(file),start,stop)
+    if not hasattr(file,'fileno'):
+        return itertools.islice(entryIterator(file),start,stop)
+    try:
+        data = mmap.mmap(file.fileno(),0,access=mmap.ACCESS_READ)
+    except (ValueError,OSError):
+        return itertools.islice(entryIterator(file),start,stop)
+    
+    offsets = None
+    if index:
+        offsets = readEntryIndex(file.name)
+        if offsets is None:
+            offsets = array('l',entryOffsetIterator(data))
+            try:
+                writeEntryIndex(file.name,offsets)
+            except OSError as e:
+                sys.stderr.write("Could not write input index: %s\n" % e)
+    else:
+        offsets = entryOffsetIterator(data)
+    
+    return _mappedEntries(data,offsets,start,stop)
+
+def streamEntryIterator(file,chunksize=1<<22):
+    '''
+    Same records as entryIterator, cut out of large reads of a file
+    that cannot be mapped, such as a compressed one.
+    '''
+    data  = file.read(max(chunksize,3))
+    begin = 0
+    if data[:3] == b'//\n':
+        yield b'//\n'
+        begin = 3
+    # the '\n' ending a record may also start the next '\n//\n'
+    search = max(begin-1,0)
+    while True:
+        end = data.find(b'\n//\n',search)
+        if end >= 0:
+            yield data[begin:end+4]
+            begin  = end + 4
+            search = end + 3
+            continue
+        chunk = file.read(chunksize)
+        if not chunk:
+            break
+        keep   = max(begin-1,0)
+        search = max(len(data)-3,search) - keep
+        data   = data[keep:] + chunk
+        begin -= keep
+
+def _mappedEntries(data,offsets,start,stop):
+    if isinstance(offsets,array):
+        # a saved index goes straight to the first wanted record
+        if stop is None:
+            offsets = offsets[start:]
+        else:
+            offsets = offsets[start:stop+1]
+        start,stop = 0,None
+    try:
+        offsets = iter(offsets)
+        begin = next(offsets,None)
+        for count,end in enumerate(offsets):
+            if stop is not None and count >= stop:
+                break
+            if count >= start:
+                yield data[begin:end]
+            begin = end
+    finally:
+        data.close()
+    
 def fastaEntryIterator(file):
     file = universalOpen(file)
     rep =[]
     for line in file:
-        if line[0] == '>' and rep:
-            rep = ''.join(rep)
+        if line[:1] == b'>' and rep:
+            rep = b''.join(rep)
             yield rep
             rep = []
         rep.append(line)
     if rep:
-        rep = ''.join(rep)
+        rep = b''.join(rep)
         yield rep
     
-_cleanSeq = re.compile('[ \n0-9]+')
+_seqUpper  = bytes.maketrans(string.ascii_lowercase.encode(),
+                             string.ascii_uppercase.encode())
+_seqDelete = b' \n' + string.digits.encode()
             
-def cleanSeq(seq):
-    return _cleanSeq.sub('',seq)
+def cleanSeq(seq,delete=_seqDelete):
+    '''
+    Upper-case a sequence block and drop spaces, newlines and the
+    position numbers in a single translate pass.
+    '''
+    return seq.translate(_seqUpper,delete)
     
     
-_gbParseID = re.compile('(?<=^LOCUS {7})[^ ]+(?= )',re.MULTILINE)   
-_gbParseDE = re.compile('(?<=^DEFINITION {2}).+?\. *$(?=[^ ])',re.MULTILINE+re.DOTALL)   
-_gbParseSQ = re.compile('(?<=^ORIGIN).+?(?=^//$)',re.MULTILINE+re.DOTALL)  
-_gbParseTX = re.compile('(?<= /db_xref="taxon:)[0-9]+(?=")')
+_gbParseID = re.compile(rb'(?<=^LOCUS {7})[^ ]+(?= )',re.MULTILINE)   
+_gbParseDE = re.compile(rb'(?<=^DEFINITION {2}).+?\. *$(?=[^ ])',re.MULTILINE+re.DOTALL)   
+_gbParseSQ = re.compile(rb'(?<=^ORIGIN).+?(?=^//$)',re.MULTILINE+re.DOTALL)  
+_gbParseTX = re.compile(rb'(?<= /db_xref="taxon:)[0-9]+(?=")')
   
 def genbankEntryParser(entry):
-    Id = _gbParseID.findall(entry)[0]
-    De = ' '.join(_gbParseDE.findall(entry)[0].split())
-    Sq = cleanSeq(_gbParseSQ.findall(entry)[0].upper())
+    # only the header is searched with regular expressions, the
+    # sequence is cut straight out of the ORIGIN block
+    origin = entry.find(b'\nORIGIN')
+    if origin < 0:
+        raise IndexError('no ORIGIN block in entry')
+    header = entry[:origin+1]
+    Id = _gbParseID.findall(header)[0]
+    De = b' '.join(_gbParseDE.findall(header)[0].split())
+    Sq = cleanSeq(entry[origin+7:entry.rfind(b'\n//')+1])
     try:
-        Tx = int(_gbParseTX.findall(entry)[0])
+        Tx = int(_gbParseTX.findall(header)[0])
     except IndexError:
         Tx = None
     return {'id':Id,'taxid':Tx,'definition':De,'sequence':Sq}
 
 ######################
 
-_cleanDef = re.compile('[\nDE]')
+_cleanDef = re.compile(b'[\nDE]')
 
 def cleanDef(definition):
-    return _cleanDef.sub('',definition)
+    return _cleanDef.sub(b'',definition)
 
-_emblParseID = re.compile('(?<=^ID {3})[^ ]+(?=;)',re.MULTILINE)   
-_emblParseDE = re.compile('(?<=^DE {3}).+?\. *$(?=[^ ])',re.MULTILINE+re.DOTALL)   
-_emblParseSQ = re.compile('(?<=^  ).+?(?=^//$)',re.MULTILINE+re.DOTALL)  
-_emblParseTX = re.compile('(?<= /db_xref="taxon:)[0-9]+(?=")')
+_emblParseID = re.compile(rb'(?<=^ID {3})[^ ]+(?=;)',re.MULTILINE)   
+_emblParseDE = re.compile(rb'(?<=^DE {3}).+?\. *$(?=[^ ])',re.MULTILINE+re.DOTALL)   
+_emblParseSQ = re.compile(rb'(?<=^  ).+?(?=^//$)',re.MULTILINE+re.DOTALL)  
+_emblParseTX = re.compile(rb'(?<= /db_xref="taxon:)[0-9]+(?=")')
 
 def emblEntryParser(entry):
     Id = _emblParseID.findall(entry)[0]
-    De = ' '.join(cleanDef(_emblParseDE.findall(entry)[0]).split())
-    Sq = cleanSeq(_emblParseSQ.findall(entry)[0].upper())
+    De = b' '.join(cleanDef(_emblParseDE.findall(entry)[0]).split())
+    Sq = cleanSeq(_emblParseSQ.findall(entry)[0])
     try:
         Tx = int(_emblParseTX.findall(entry)[0])
     except IndexError:
@@ -330,25 +1770,28 @@ def emblEntryParser(entry):
 
 ######################
 
-_fastaSplit=re.compile(';\W*')
+_fastaSplit=re.compile(rb';\W*')
 
 def parseFasta(seq):
-    seq=seq.split('\n')
+    seq=seq.split(b'\n',1)
     title = seq[0].strip()[1:].split(None,1)
     id=title[0]
     if len(title) == 2:
         field = _fastaSplit.split(title[1])
     else:
         field=[]
-    info = dict(x.split('=',1) for x in field if '=' in x)
-    definition = ' '.join([x for x in field if '=' not in x])
-    seq=(''.join([x.strip() for x in seq[1:]])).upper()   
+    info = dict(x.split(b'=',1) for x in field if b'=' in x)
+    definition = b' '.join([x for x in field if b'=' not in x])
+    if len(seq) == 2:
+        seq=cleanSeq(seq[1],string.whitespace.encode())
+    else:
+        seq=b''
     return id,seq,definition,info
 
   
 def fastaEntryParser(entry):
     id,seq,definition,info = parseFasta(entry)
-    Tx = info.get('taxid',None)   
+    Tx = info.get(b'taxid',None)   
     if Tx is not None:
         Tx=int(Tx)
     return {'id':id,'taxid':Tx,'definition':definition,'sequence':seq}
@@ -358,37 +1801,37 @@ def sequenceIteratorFactory(entryParser,entryIterator):
     def sequenceIterator(file):
         for entry in entryIterator(file):
             yield entryParser(entry)
+    # kept so that ecoSeqWriter can spread parsing over a process pool
+    sequenceIterator.entryParser = entryParser
+    sequenceIterator.entryIterator = entryIterator
     return sequenceIterator
 
 
-def taxonomyInfo(entry,connection):
-    taxid = entry['taxid']
-    curseur = connection.cursor()
-    curseur.execute("""
-                        select taxid,species,genus,family,
-                               taxonomy.scientificName(taxid) as sn,
-                               taxonomy.scientificName(species) as species_sn,
-                               taxonomy.scientificName(genus) as genus_sn,
-                               taxonomy.scientificName(family) as family_sn
-                        from
-                            (   
-                             select alias                      as taxid,
-                               taxonomy.getSpecies(alias) as species,
-                               taxonomy.getGenus(alias)   as genus,
-                               taxonomy.getFamily(alias)  as family
-                                from taxonomy.aliases
-                               where id=%d ) as tax
-                    """ % taxid)
-    rep = curseur.fetchone()
-    entry['current_taxid']=rep[0]
-    entry['species']=rep[1]
-    entry['genus']=rep[2]
-    entry['family']=rep[3]
-    entry['scientific_name']=rep[4]
-    entry['species_sn']=rep[5]
-    entry['genus_sn']=rep[6]
-    entry['family_sn']=rep[7]
-    return entry
+def taxonomyInfo(entry,lineage):
+    '''
+    Add the current taxid, species, genus and family of entry['taxid']
+    and their scientific names to entry, from a LineageIndex. Fields
+    are None when the taxid or the rank is missing.
+    '''
+    return taxonomyInfos([entry],lineage)[0]
+
+def taxonomyInfos(entries,lineage):
+    '''
+    taxonomyInfo for a batch of entries, one rank at a time.
+    '''
+    taxids = [entry['taxid'] for entry in entries]
+    for entry,taxid in zip(entries,taxids):
+        row = lineage.row(taxid)
+        if row is None:
+            entry['current_taxid']=None
+        else:
+            entry['current_taxid']=lineage.taxonomy.taxids[row]
+        entry['scientific_name']=lineage.name(entry['current_taxid'])
+    for rank in ('species','genus','family'):
+        for entry,found in zip(entries,lineage.ancestorsAt(taxids,rank)):
+            entry[rank]=found
+            entry[rank + '_sn']=lineage.name(found)
+    return entries
     
 #####
 #
@@ -398,9 +1841,27 @@ def taxonomyInfo(entry,connection):
 #
 #####
     
+def ecoSeqCompressor(sq,keep=False):
+    '''
+    Replace the sequence of an entry by its compressed form, as
+    expected by ecoSeqPacker. Used by ecoSeqWriter worker processes
+    so that only the compressed sequence is sent back, unless keep
+    is set because the sequence is also written out as FASTA.
+    '''
+    sq['seqlength']  = len(sq['sequence'])
+    sq['compactseq'] = zlib.compress(sq['sequence'],9)
+    if not keep:
+        del sq['sequence']
+    return sq
+    
 def ecoSeqPacker(sq):
     
-    compactseq = gzip.zlib.compress(sq['sequence'],9)
+    if 'compactseq' in sq:
+        compactseq = sq['compactseq']
+        seqlength  = sq['seqlength']
+    else:
+        compactseq = zlib.compress(sq['sequence'],9)
+        seqlength  = len(sq['sequence'])
     cptseqlength  = len(compactseq)
     delength   = len(sq['definition'])
     
@@ -411,7 +1872,7 @@ def ecoSeqPacker(sq):
                          sq['taxid'],
                          sq['id'],
                          delength,
-                         len(sq['sequence']),
+                         seqlength,
                          cptseqlength,
                          sq['definition'],
                          compactseq)
@@ -420,29 +1881,32 @@ def ecoSeqPacker(sq):
     
     return packed
 
+# record headers; the variable length strings follow them
+_countHeader = struct.Struct('> I')
+# size, taxon row, id, definition length, sequence length, compressed length
+_seqHeader   = struct.Struct('> I I 20s I I I')
+# size, taxid, rank, parent row, name length
+_taxHeader   = struct.Struct('> I I I I I')
+# size, is scientific name, name length, class name length, taxon row
+_nameHeader  = struct.Struct('> I I I I I')
+
 def ecoTaxPacker(tx):
     
     namelength = len(tx[3])
     
     totalSize = 4 + 4 + 4 + 4 + namelength
     
-    packed = struct.pack('> I I I I I %ds' % namelength, 
-                         totalSize, 
-                         tx[0],
-                         tx[1],
-                         tx[2], 
-                         namelength,
-                         tx[3])
+    packed = _taxHeader.pack(totalSize, 
+                             tx[0],
+                             tx[1],
+                             tx[2], 
+                             namelength) + tx[3]
     
     return packed
 
 def ecoRankPacker(rank):
     
-    namelength = len(rank)
-    
-    packed = struct.pack('> I %ds' % namelength,
-                         namelength,
-                         rank)
+    packed = _countHeader.pack(len(rank)) + rank
     
     return packed
                 
@@ -452,72 +1916,415 @@ def ecoNamePacker(name):
     classlength= len(name[1])
     totalSize =  namelength + classlength + 4 + 4 + 4 + 4
     
-    packed = struct.pack('> I I I I I %ds %ds' % (namelength,classlength),
-                         totalSize,
-                         int(name[1]=='scientific name'),
-                         namelength,
-                         classlength,
-                         name[2],
-                         name[0],
-                         name[1])
+    packed = _nameHeader.pack(totalSize,
+                              int(name[1]==b'scientific name'),
+                              namelength,
+                              classlength,
+                              name[2]) + name[0] + name[1]
     
     return packed
     
-def ecoSeqWriter(file,input,taxindex,parser):
-    output = open(file,'wb')
-    input  = universalOpen(input)
-    entries = parser(input)
-    seqcount=0
-    skipped = []
+def ecoFastaFormatter(sq,taxid):
+    '''
+    An entry as an ecoPCR style FASTA record, which fastaEntryParser
+    reads back.
+    '''
+    seq = sq['sequence']
+    lines = [b'>%s taxid=%d; %s\n' % (sq['id'],taxid,sq['definition'])]
+    lines.extend(seq[i:i+60] + b'\n' for i in range(0,len(seq),60))
+    return b''.join(lines)
+    
+_workerEntryParser = None
+_workerKeepSequence = False
+_workerHashSequence = False
+
+def _initSeqWorker(entryParser,keepSequence=False,hashSequence=False):
+    global _workerEntryParser, _workerKeepSequence, _workerHashSequence
+    _workerEntryParser = entryParser
+    _workerKeepSequence = keepSequence
+    _workerHashSequence = hashSequence
+    
+def _parseSized(entryParser,entry):
+    # the size of the raw entry is kept for the throughput statistics
+    sq = entryParser(entry)
+    sq['entrysize'] = len(entry)
+    return sq
+    
+def _parseAndCompress(entry):
+    sq = _parseSized(_workerEntryParser,entry)
+    if sq['taxid'] is not None:
+        if _workerHashSequence:
+            sq['seqhash'] = seqHash(sq['sequence'])
+        ecoSeqCompressor(sq,_workerKeepSequence)
+    return sq
+
+class SeqShardWriter(object):
+    '''
+    Write packed sequences to prefix_001.sdx, prefix_002.sdx, ...
+    A shard is closed, and its record count written, as soon as it
+    holds maxRecords records or the next record would take it past
+    maxBytes bytes, so finished shards can be used while the next ones
+    are written. names overrides the default file names.
+    '''
+    
+    def __init__(self,prefix,maxRecords=None,maxBytes=None,names=None,first=1):
+        if names is None:
+            names = ('%s_%03d.sdx' % (prefix,n) for n in itertools.count(first))
+        self._names     = iter(names)
+        self.maxRecords = maxRecords
+        self.maxBytes   = maxBytes
+        self.files      = []
+        self._output    = None
+        
+    def newShard(self):
+        self.close()
+        self._count  = 0
+        self._size   = 4
+        self._output = open(next(self._names),'wb')
+        self._output.write(struct.pack('> I',0))
+        self.files.append(self._output.name)
+        
+    def reopen(self,name):
+        '''
+        Continue writing at the end of an existing shard.
+        '''
+        self.close()
+        self._output = open(name,'r+b')
+        self._count  = struct.unpack('> I',self._output.read(4))[0]
+        self._output.seek(0,2)
+        self._size   = self._output.tell()
+        self.files.append(name)
+        
+    def _full(self,size):
+        if not self._count:
+            return False
+        if self.maxRecords and self._count >= self.maxRecords:
+            return True
+        if self.maxBytes and self._size + size > self.maxBytes:
+            return True
+        return False
+    
+    def write(self,packed):
+        if self._output is None or self._full(len(packed)):
+            self.newShard()
+        self._output.write(packed)
+        self._count+=1
+        self._size+=len(packed)
+        
+    def close(self):
+        if self._output is not None:
+            self._output.seek(0,0)
+            self._output.write(struct.pack('> I',self._count))
+            self._output.close()
+            self._output = None
+
+def seqHash(sequence):
+    return hashlib.md5(sequence).digest()
+
+def packedSeqHash(packed):
+    '''
+    seqHash of the sequence of a record packed by ecoSeqPacker.
+    '''
+    header = _seqHeader.unpack_from(packed)
+    start = _seqHeader.size + header[3]
+    return seqHash(zlib.decompress(packed[start:start + header[5]]))
 
-    output.write(struct.pack('> I',seqcount))
+class SeqDeduplicator(object):
+    '''
+    Decide which sequences go in the database. With dedup, a sequence
+    identical to one already kept for the same taxon is collapsed into
+    it; with maxPerSpecies, a species (or a taxon above species level)
+    keeps at most that many sequences, besides the first sequence of
+    each of its taxa, which is always kept. Either way every taxon
+    keeps at least one sequence. Records left out are listed in the
+    mapfile, a TSV of collapsed id, kept id, taxid and reason.
+    '''
+    
+    def __init__(self,taxonomy,mapfile,dedup=True,maxPerSpecies=None):
+        self.taxids  = taxonomy[0].taxids
+        self.mapfile = mapfile
+        self.dedup   = dedup
+        self.maxPerSpecies = maxPerSpecies
+        self.lineage = LineageIndex(taxonomy) if maxPerSpecies else None
+        self.duplicates = 0
+        self.capped     = 0
+        self._kept     = {}     # (taxid, sequence hash) -> id
+        self._counts   = {}     # species taxid -> sequences kept
+        self._present  = set()  # taxids with a sequence kept
+        self._existing = set()
+        self._listed   = set()  # lines already in the mapfile
+        self._output   = None
+        
+    def open(self,append=False):
+        '''
+        With append, the records left out by an earlier run are kept in
+        the mapfile and not listed twice when they are left out again.
+        '''
+        if append and os.path.exists(self.mapfile):
+            listed = open(self.mapfile)
+            self._listed.update(listed)
+            listed.close()
+        self._output = open(self.mapfile,'a' if append else 'w')
+        if not self._output.tell():
+            self._output.write('#collapsed\tkept\ttaxid\treason\n')
+            
+    def _speciesOf(self,taxid):
+        species = self.lineage.ancestorAt(taxid,'species')
+        return taxid if species is None else species
     
+    def _leaveOut(self,id,kept,taxid,reason):
+        line = '%s\t%s\t%d\t%s\n' % (id.decode('latin-1'),
+                                     kept.decode('latin-1'),taxid,reason)
+        if line not in self._listed:
+            self._output.write(line)
+        
+    def register(self,id,taxid,sequenceHash=None):
+        '''
+        Account for a sequence already in the database.
+        '''
+        self._existing.add(id)
+        self._present.add(taxid)
+        if self.dedup:
+            self._kept.setdefault((taxid,sequenceHash),id)
+        if self.maxPerSpecies:
+            species = self._speciesOf(taxid)
+            self._counts[species] = self._counts.get(species,0) + 1
+            
+    def admit(self,entry,row):
+        '''
+        True when the parsed entry, of taxonomy row, is to be written.
+        '''
+        id = entry['id']
+        taxid = self.taxids[row]
+        if self.dedup:
+            sequenceHash = entry.get('seqhash')
+            if sequenceHash is None:
+                sequenceHash = seqHash(entry['sequence'])
+            key = (taxid,sequenceHash)
+            kept = self._kept.get(key)
+            if kept is not None and kept != id:
+                self._leaveOut(id,kept,taxid,'duplicate')
+                self.duplicates+=1
+                return False
+        # a new version of a record in the database replaces it
+        if id not in self._existing and self.maxPerSpecies:
+            species = self._speciesOf(taxid)
+            count = self._counts.get(species,0)
+            # the cap never takes the last chance of a taxon, such as a
+            # subspecies after its species is full
+            if count >= self.maxPerSpecies and taxid in self._present:
+                self._leaveOut(id,b'',species,'species cap')
+                self.capped+=1
+                return False
+            self._counts[species] = count + 1
+        if self.dedup:
+            self._kept.setdefault(key,id)
+        self._present.add(taxid)
+        return True
+    
+    def close(self):
+        self._output.close()
+        sys.stderr.write("%d duplicate sequences collapsed and %d left out "
+                         "by the species cap, listed in %s\n" % 
+                         (self.duplicates,self.capped,self.mapfile))
+
+def _changedEntries(entries,digests,pending,keepUnchanged=False):
+    '''
+    Pass on the entries whose digest is not in digests. Every entry
+    leaves its digest in pending, in input order, along with its fate,
+    size and, when keepUnchanged, the entry itself when it is passed
+    over, so ecoSeqWriter can match them with the parsed entries.
+    '''
     for entry in entries:
+        digest = hashlib.md5(entry).digest()
+        fate = digests.fate(digest)
+        if fate is None:
+            pending.append((digest,None,0,None))
+            yield entry
+        else:
+            pending.append((digest,fate,len(entry),
+                            entry if keepUnchanged else None))
+
+def ecoSeqWriter(file,input,taxindex,parser,jobs=1,fasta=None,
+                 selection=None,dedup=None,digests=None):
+    '''
+    file is either a file name or an object with a write method for
+    packed records, such as a SeqShardWriter, which is left open for
+    the next input. Every sequence put in the database is also written
+    to the fasta file object when one is given. With a TaxonSelection,
+    sequences of other taxa are left out, and with a SeqDeduplicator
+    the sequences it does not admit.
+    
+    With jobs > 1, entries are parsed and compressed by a pool of
+    worker processes. imap hands results back in input order, so the
+    file is identical to the one written with a single process.
+    
+    The digest of every entry and its fate are recorded in digests, a
+    SeqDigests, when one is given. The entries it already holds are
+    passed over before they are parsed, as the database holds them
+    already; they are only parsed again for the fasta file.
+    '''
+    if hasattr(file,'write'):
+        output = file
+    else:
+        output = SeqShardWriter(None,names=[file])
+        output.newShard()
+    opened = isinstance(input,str)
+    if opened:
+        progress = SeqProgress(input,os.path.getsize(input))
+    else:
+        progress = SeqProgress(getattr(input,'name','-'))
+    # jobs is the number of processes for the whole file. bgzip blocks
+    # inflate about ten times faster than entries are parsed, so a
+    # bgzip file takes one process in eight out of the parsing pool,
+    # and below sixteen jobs it is inflated here
+    inflaters = jobs // 8
+    input  = universalOpen(input,inflaters)
+    if isinstance(input,BgzfReader):
+        jobs -= inflaters
+    if isinstance(input,GzipReader):
+        # compressed files only know how far they are in the compressed data
+        progress.where = lambda: universalTell(input)
+    raw = parser.entryIterator(input)
+    pending = None
+    if digests is not None:
+        # filled by the thread feeding the pool, always ahead of the
+        # results, so the entries passed over before a result are in
+        # pending when it comes back
+        pending = collections.deque()
+        raw = _changedEntries(raw,digests,pending,fasta is not None)
+    if jobs > 1:
+        pool = multiprocessing.Pool(jobs,_initSeqWorker,
+                                    (parser.entryParser,fasta is not None,
+                                     dedup is not None and dedup.dedup))
+        entries = pool.imap(_parseAndCompress,raw,64)
+    else:
+        pool = None
+        entries = (_parseSized(parser.entryParser,entry) for entry in raw)
+    skipped = []
+    
+    def passUnchanged():
+        while pending and pending[0][1] is not None:
+            digest,fate,size,entry = pending.popleft()
+            if fate == 'written':
+                output.unchanged+=1
+                if fasta is not None:
+                    entry = parser.entryParser(entry)
+                    fasta.write(ecoFastaFormatter(entry,entry['taxid']))
+            progress.update(size,False,fate == 'outside',
+                            fate == 'collapsed')
+
+    for entry in entries:
+        if pending is not None:
+            passUnchanged()
+            digest = pending.popleft()[0]
+        outside = collapsed = False
         if entry['taxid'] is not None:
+            taxid = entry['taxid']
             try:
-                entry['taxid']=taxindex[entry['taxid']]
+                row = taxindex[entry['taxid']]
             except KeyError:
-                entry['taxid']=None
+                row = None
+            entry['taxid']=row
+            if row is not None and selection is not None:
+                entry['taxid']=selection.row(row)
+                outside = entry['taxid'] is None
+            if entry['taxid'] is not None and dedup is not None:
+                collapsed = not dedup.admit(entry,row)
+                if collapsed:
+                    entry['taxid']=None
             if entry['taxid'] is not None:
-                seqcount+=1
                 output.write(ecoSeqPacker(entry))
-            else:
+                if fasta is not None:
+                    fasta.write(ecoFastaFormatter(entry,taxid))
+            elif not (outside or collapsed):
                 skipped.append(entry['id'])
-            where = universalTell(input)
-            # progressBar(where, inputsize)
-            # sys.stderr.write(" Readed sequences : %d     " % seqcount,
         else:
             skipped.append(entry['id'])
+        progress.update(entry['entrysize'],
+                        entry['taxid'] is None and not (outside or collapsed),
+                        outside,collapsed)
+        if digests is not None:
+            if entry['taxid'] is not None:
+                digests.record(entry['id'],digest,'written')
+            elif outside:
+                digests.record(entry['id'],digest,'outside')
+            elif collapsed:
+                digests.record(entry['id'],digest,'collapsed')
+    if pending is not None:
+        passUnchanged()
         
-    output.seek(0,0)
-    output.write(struct.pack('> I',seqcount))
-    
-    output.close()
+    progress.finish()
+    if progress.outside:
+        sys.stderr.write("%d sequences outside the selected taxa left out\n" %
+                         progress.outside)
+    buildStats.sequences.append(progress)
+    if pool is not None:
+        pool.close()
+        pool.join()
+    if opened:
+        input.close()
+        
+    if output is not file:
+        output.close()
     return skipped
         
 
-def ecoTaxWriter(file,taxonomy):
+def writeRecordChunks(file,count,chunks):
+    '''
+    Write a .tdx or .ndx file: the record count, then the records,
+    which chunks yields as lists of packed pieces. Each list is
+    joined and written at once, so the file gets a few large writes
+    instead of millions of small ones.
+    '''
     output = open(file,'wb')
-    output.write(struct.pack('> I',len(taxonomy)))
+    output.write(_countHeader.pack(count))
+    for pieces in chunks:
+        output.write(b''.join(pieces))
+    output.close()
     
-    for tx in taxonomy:
-        output.write(ecoTaxPacker(tx))
+def ecoTaxChunks(taxonomy,chunk=1<<16):
+    '''
+    The rows of a Taxonomy packed as by ecoTaxPacker, chunk rows at a
+    time, straight from its arrays. Names are views on the StringBlob.
+    '''
+    pack    = _taxHeader.pack
+    data    = memoryview(taxonomy.strings._data)
+    offsets = taxonomy.strings._offsets
+    for low in range(0,len(taxonomy),chunk):
+        high = low + chunk
+        pieces = []
+        append = pieces.append
+        for taxid,rank,parent,name in zip(taxonomy.taxids[low:high],
+                                          taxonomy.rankcodes[low:high],
+                                          taxonomy.parents[low:high],
+                                          taxonomy.names[low:high]):
+            if name < 0:
+                append(pack(16,taxid,rank,parent,0))
+                continue
+            start = offsets[name]
+            namelength = offsets[name+1] - start
+            append(pack(16 + namelength,taxid,rank,parent,namelength))
+            append(data[start:start+namelength])
+        yield pieces
 
-    output.close()
+def ecoTaxWriter(file,taxonomy):
+    writeRecordChunks(file,len(taxonomy),ecoTaxChunks(taxonomy))
     
 def ecoRankWriter(file,ranks):
     output = open(file,'wb')
-    output.write(struct.pack('> I',len(ranks)))
+    output.write(_countHeader.pack(len(ranks)))
 
-    rankNames = ranks.keys()
-    rankNames.sort()
-    
-    for rank in rankNames:
+    for rank in sorted(ranks):
         output.write(ecoRankPacker(rank))
 
     output.close()
 
 def nameCmp(n1,n2):
+    '''
+    The reference order of the .ndx file; NameTable.sortByName gives
+    the same order faster, which ecodb_bench.py golden checks.
+    '''
     name1=n1[0].upper()
     name2=n2[0].upper()
     if name1 < name2:
@@ -527,51 +2334,355 @@ def nameCmp(n1,n2):
     return 0
 
 
-def ecoNameWriter(file,names):
-    output = open(file,'wb')
-    output.write(struct.pack('> I',len(names)))
+def ecoNameChunks(names,chunk=1<<16):
+    '''
+    The names of a NameTable packed as by ecoNamePacker, chunk names
+    at a time; see ecoTaxChunks.
+    '''
+    pack    = _nameHeader.pack
+    data    = memoryview(names.strings._data)
+    offsets = names.strings._offsets
+    # (class name, its length, is scientific name) by class code
+    classes = [(c,len(c),int(c==b'scientific name')) for c in names.classNames]
+    for low in range(0,len(names),chunk):
+        high = low + chunk
+        pieces = []
+        append = pieces.append
+        for name,code,taxon in zip(names.names[low:high],
+                                   names.classes[low:high],
+                                   names.taxa[low:high]):
+            classname,classlength,scientific = classes[code]
+            start = offsets[name]
+            namelength = offsets[name+1] - start
+            append(pack(16 + namelength + classlength,scientific,
+                        namelength,classlength,taxon))
+            append(data[start:start+namelength])
+            append(classname)
+        yield pieces
 
-    names.sort(nameCmp)
+def ecoNameWriter(file,names):
+    names.sortByName()
     
-    for name in names:
-        output.write(ecoNamePacker(name))
+    writeRecordChunks(file,len(names),ecoNameChunks(names))
 
-    output.close()
+def recordRange(text):
+    '''
+    (start, stop) of a --input-records START:STOP argument.
+    '''
+    try:
+        start,stop = text.split(':')
+        start = int(start) if start else 0
+        stop  = int(stop) if stop else None
+    except ValueError:
+        raise ValueError('--input-records takes START:STOP, such as 1000:2000')
+    if start < 0 or (stop is not None and stop < start):
+        raise ValueError('--input-records needs 0 <= START <= STOP')
+    return start,stop
 
-def infile_parser_picker(infile_type):
+def infile_parser_picker(infile_type,index=False,records=None):
+    '''
+    records, a (start, stop) range of record numbers, limits the
+    entries read to that range.
+    '''
+    start,stop = records or (0,None)
+    mmapped = functools.partial(mmapEntryIterator,index=index,
+                                start=start,stop=stop)
     if infile_type == 'genbank':
-        infile_parser = sequenceIteratorFactory(genbankEntryParser, 
-                            entryIterator)
+        infile_parser = sequenceIteratorFactory(genbankEntryParser,mmapped)
     elif infile_type == 'fasta':
         infile_parser = sequenceIteratorFactory(fastaEntryParser, 
-                            fastaEntryIterator)
+                            lambda file: itertools.islice(
+                                fastaEntryIterator(file),start,stop))
     elif infile_type == 'embl':
-        infile_parser = sequenceIteratorFactory(emblEntryParser, 
-                            entryIterator)
+        infile_parser = sequenceIteratorFactory(emblEntryParser,mmapped)
     else:
         raise ValueError("could not pick an infile parser")
     return(infile_parser)
 
-def ecoDBWriter(prefix,taxonomy,seqFileNames):
+#####
+#
+#
+# Incremental update
+#
+#
+#####
+
+def ecoSeqReader(file):
+    '''
+    Iterate over the packed records of a .sdx file, as written by
+    ecoSeqPacker.
+    '''
+    input = open(file,'rb')
+    count = struct.unpack('> I',input.read(4))[0]
+    for i in range(count):
+        size = input.read(4)
+        yield size + input.read(struct.unpack('> I',size)[0])
+    input.close()
+    
+def packedSeqId(packed):
+    return packed[8:28].rstrip(b'\0')
+
+def seqShardNames(prefix):
+    return sorted(glob.glob('%s_[0-9][0-9][0-9].sdx' % prefix))
+
+def removeStaleShards(prefix,written):
+    '''
+    Remove the shards of an earlier build of prefix that are not among
+    the files just written, so they are not read as part of the new
+    database, and the sidecar index of ecodb_reader.py along.
+    '''
+    for name in seqShardNames(prefix):
+        if name not in written:
+            os.remove(name)
+    if os.path.exists('%s.ecosdi' % prefix):
+        os.remove('%s.ecosdi' % prefix)
+
+def taxdumpStampName(prefix):
+    return '%s.taxstamp' % prefix
+
+def selectionKey(selection):
+    if selection is None:
+        return None
+    return selection.key()
+
+def writeTaxdumpStamp(prefix,taxdir,selection=None):
+    '''
+    Record which taxdump, and which selection of its taxa, the
+    .tdx/.ndx/.rdx files were built from.
+    '''
+    output = open(taxdumpStampName(prefix),'wb')
+    marshal.dump({'signature': taxdumpSignature(taxdir),
+                  'selection': selectionKey(selection)},output)
+    output.close()
+    
+def sameTaxdumpStamp(prefix,taxdir,selection=None):
+    try:
+        stamp = open(taxdumpStampName(prefix),'rb')
+    except IOError:
+        return False
+    try:
+        built = marshal.load(stamp)
+        signature = built['signature']
+        if built['selection'] != selectionKey(selection):
+            return False
+    except (EOFError,ValueError,TypeError,KeyError):
+        return False
+    finally:
+        stamp.close()
+    return sameTaxdump(taxdir,signature)
+
+def rewriteSeqShard(file,replacements):
+    '''
+    Copy a shard, swapping the records whose id is a key of
+    replacements for the packed record it maps to.
+    '''
+    tmp = '%s.%d.tmp' % (file,os.getpid())
+    output = open(tmp,'wb')
+    count = 0
+    output.write(struct.pack('> I',count))
+    for packed in ecoSeqReader(file):
+        output.write(replacements.get(packedSeqId(packed),packed))
+        count+=1
+    output.seek(0,0)
+    output.write(struct.pack('> I',count))
+    output.close()
+    os.rename(tmp,file)
+    
+class SeqUpdateWriter(object):
+    '''
+    Record sink used by --update in place of a SeqShardWriter.
+    A record whose id is already in the database is dropped when it
+    packs to the same bytes and queued for an in-place replacement
+    when it does not; new ids are appended to the shards.
+    '''
+    
+    def __init__(self,shards,known):
+        self.shards    = shards
+        self.known     = known
+        self.replaced  = {}
+        self.added     = 0
+        self.changed   = 0
+        self.unchanged = 0
+        
+    def write(self,packed):
+        id = packedSeqId(packed)
+        old = self.known.get(id)
+        if old is None:
+            self.shards.write(packed)
+            self.added+=1
+        elif old[1] == hashlib.md5(packed).digest():
+            self.unchanged+=1
+        else:
+            self.replaced.setdefault(old[0],{})[id]=packed
+            self.changed+=1
+            
+    def close(self):
+        self.shards.close()
+        for file,replacements in self.replaced.items():
+            rewriteSeqShard(file,replacements)
+            
+class SeqDigests(object):
+    '''
+    MD5 digests of the raw entries a database was built from, by id,
+    with what became of each: written, left outside the selected taxa
+    or collapsed. They are saved in prefix.ecodig for --update to pass
+    over the entries that did not change. The entries left out only
+    count when options, the SeqDeduplicator settings, are unchanged.
+    '''
+    
+    def __init__(self,prefix,options=None):
+        self.file    = '%s.ecodig' % prefix
+        self.options = options
+        self.entries = {}     # id -> (digest, fate)
+        self._fates  = {}     # digest -> fate, of the loaded entries
+        
+    def load(self):
+        try:
+            input = open(self.file,'rb')
+        except IOError:
+            return
+        try:
+            saved = marshal.load(input)
+            entries = saved['entries']
+            options = saved['options']
+        except (EOFError,ValueError,TypeError,KeyError):
+            return
+        finally:
+            input.close()
+        for id,(digest,fate) in entries.items():
+            if fate == 'written' or options == self.options:
+                self.entries[id] = (digest,fate)
+                self._fates[digest] = fate
+                
+    def fate(self,digest):
+        return self._fates.get(digest)
+    
+    def record(self,id,digest,fate):
+        self.entries[id] = (digest,fate)
+        
+    def save(self):
+        output = open(self.file,'wb')
+        marshal.dump({'options': self.options,
+                      'entries': self.entries},output)
+        output.close()
+
+def dedupOptions(dedup):
+    if dedup is None:
+        return None
+    return (dedup.dedup,dedup.maxPerSpecies)
+
+def ecoDBUpdater(prefix,taxdir,taxonomy,seqFileNames,jobs=1,
+                 maxRecords=None,maxBytes=None,index=False,fasta=None,
+                 selection=None,dedup=None,records=None):
+    '''
+    Bring an existing database up to date with seqFileNames. Return
+    False, without touching anything, when the database is missing or
+    was built from another taxdump or taxon selection: the taxon
+    numbers packed in the .sdx records would not match anymore.
+    Entries whose raw text is the same as in the last build or update
+    are passed over without being parsed, after their SeqDigests.
+    '''
+    existing = seqShardNames(prefix)
+    if not existing or not sameTaxdumpStamp(prefix,taxdir,selection):
+        return False
+    
+    sys.stderr.write("Updating database...\n")
+    buildStats.phase('update: read database')
+    
+    known = {}
+    if dedup is not None:
+        dedup.open(append=True)
+        written = taxonomy if selection is None else selection.taxonomy
+        taxids = written[0].taxids
+    for file in existing:
+        for packed in ecoSeqReader(file):
+            known[packedSeqId(packed)] = (file,hashlib.md5(packed).digest())
+            if dedup is not None:
+                dedup.register(packedSeqId(packed),
+                               taxids[_seqHeader.unpack_from(packed)[1]],
+                               packedSeqHash(packed) if dedup.dedup else None)
+    
+    digests = SeqDigests(prefix,dedupOptions(dedup))
+    digests.load()
+    shards = SeqShardWriter(prefix,maxRecords,maxBytes,first=len(existing)+1)
+    shards.reopen(existing[-1])
+    output = SeqUpdateWriter(shards,known)
+    buildStats.phase('write sequences')
+    for filename in seqFileNames:
+        infile_type, filename = infile_opener(filename)
+        the_parser = infile_parser_picker(infile_type,index,records)
+        sk=ecoSeqWriter(output, 
+                     filename, 
+                     taxonomy[3], 
+                     the_parser,
+                     jobs,
+                     fasta,
+                     selection,
+                     dedup,
+                     digests)
+        if sk:
+            sys.stderr.write("Skipped entry :\n")
+            sys.stderr.write("\n".join(id.decode('latin-1') for id in sk) 
+                             + "\n")
+    buildStats.phase('update: rewrite shards')
+    output.close()
+    digests.save()
+    buildStats.end()
+    if dedup is not None:
+        dedup.close()
+    
+    sys.stderr.write("%d new, %d changed and %d unchanged sequences\n" % 
+                     (output.added,output.changed,output.unchanged))
+    return True
+
+def ecoDBWriter(prefix,taxonomy,seqFileNames,jobs=1,
+                maxRecords=None,maxBytes=None,index=False,fasta=None,
+                selection=None,dedup=None,records=None):
+    '''
+    With a TaxonSelection, only the sequences of the selected taxa are
+    written, along with its taxonomy, pruned or not. With a
+    SeqDeduplicator, only the sequences it admits.
+    '''
     
     sys.stderr.write("Writing database...\n")
     
-    ecoRankWriter('%s.rdx' % prefix, taxonomy[1])
-    ecoTaxWriter('%s.tdx' % prefix, taxonomy[0])
-    ecoNameWriter('%s.ndx' % prefix, taxonomy[2])
+    written = taxonomy if selection is None else selection.taxonomy
+    buildStats.phase('write ranks')
+    ecoRankWriter('%s.rdx' % prefix, written[1])
+    buildStats.phase('write taxa')
+    ecoTaxWriter('%s.tdx' % prefix, written[0])
+    buildStats.phase('write names')
+    ecoNameWriter('%s.ndx' % prefix, written[2])
   
-    filecount = 0
+    # every input file starts a new shard
+    buildStats.phase('write sequences')
+    if dedup is not None:
+        dedup.open()
+    digests = SeqDigests(prefix,dedupOptions(dedup))
+    shards = SeqShardWriter(prefix,maxRecords,maxBytes)
     for filename in seqFileNames:
-        infile_type = infile_type_checker(filename)
-        the_parser = infile_parser_picker(infile_type)
-        filecount+=1
-        sk=ecoSeqWriter('%s_%03d.sdx' % (prefix,filecount), 
+        infile_type, filename = infile_opener(filename)
+        the_parser = infile_parser_picker(infile_type,index,records)
+        shards.newShard()
+        sk=ecoSeqWriter(shards, 
                      filename, 
                      taxonomy[3], 
-                     the_parser)
+                     the_parser,
+                     jobs,
+                     fasta,
+                     selection,
+                     dedup,
+                     digests)
         if sk:
             sys.stderr.write("Skipped entry :\n")
-            sys.stderr.write(sk + "\n")
+            sys.stderr.write("\n".join(id.decode('latin-1') for id in sk) 
+                             + "\n")
+    shards.close()
+    removeStaleShards(prefix,shards.files)
+    digests.save()
+    buildStats.end()
+    if dedup is not None:
+        dedup.close()
         
 if __name__ == '__main__':
     
@@ -581,7 +2692,11 @@ if __name__ == '__main__':
 
     taxon_time_start = datetime.now()
 
-    taxonomy = readTaxonomyDump(args['taxonomy'])
+    if args['no_taxonomy_cache']:
+        taxonomy = readTaxonomyDump(args['taxonomy'])
+    else:
+        taxonomy = cachedTaxonomyDump(args['taxonomy'], 
+                                      args['taxonomy_cache'])
     
     taxon_time_end = datetime.now()
 
@@ -589,12 +2704,69 @@ if __name__ == '__main__':
 
     sys.stderr.write("Taxonomy compilation completed in: " + duration_taxonomy + "\n")
     
-    infile_type = infile_type_checker(args['input'])
-    the_parser = infile_parser_picker(infile_type)
-    ecoDBWriter(args['output'], taxonomy, [args['input']])
+    if args['include_taxid'] or args['exclude_taxid']:
+        try:
+            selection = TaxonSelection(taxonomy, args['include_taxid'] or (),
+                                       args['exclude_taxid'] or (),
+                                       args['prune_taxonomy'])
+        except ValueError as e:
+            parser.error(str(e))
+    elif args['prune_taxonomy']:
+        parser.error('--prune-taxonomy needs --include-taxid or '
+                     '--exclude-taxid')
+    else:
+        selection = None
+    
+    if args['max_per_species'] is not None and args['max_per_species'] < 1:
+        parser.error('--max-per-species must be at least 1')
+    if args['dedup'] or args['max_per_species']:
+        dedup = SeqDeduplicator(taxonomy, 
+                                args['dedup_map'] or 
+                                '%s.collapsed.tsv' % args['output'],
+                                args['dedup'], args['max_per_species'])
+    else:
+        dedup = None
+    
+    if args['input_records']:
+        try:
+            records = recordRange(args['input_records'])
+        except ValueError as e:
+            parser.error(str(e))
+    else:
+        records = None
+    
+    if args['fasta_out']:
+        fasta = open(args['fasta_out'], 'wb')
+    else:
+        fasta = None
+    if args['shard_size']:
+        shard_bytes = int(args['shard_size'] * 1024 * 1024)
+    else:
+        shard_bytes = None
+    updated = False
+    if args['update']:
+        updated = ecoDBUpdater(args['output'], args['taxonomy'], taxonomy,
+                               [args['input']], args['jobs'],
+                               args['shard_records'], shard_bytes, 
+                               args['index_input'], fasta, selection, dedup,
+                               records)
+        if not updated:
+            sys.stderr.write("No database built from this taxonomy and "
+                             "selection of taxa at %s, rebuilding it\n" % 
+                             args['output'])
+    if not updated:
+        ecoDBWriter(args['output'], taxonomy, [args['input']], args['jobs'],
+                    args['shard_records'], shard_bytes, args['index_input'],
+                    fasta, selection, dedup, records)
+        writeTaxdumpStamp(args['output'], args['taxonomy'], selection)
+    if fasta is not None:
+        fasta.close()
 
     full_time_end = datetime.now()
     
     duration_full = str(full_time_end - full_time_start)
     
     sys.stderr.write("Completed in: " + duration_full + "\n")
+    buildStats.summary()
+    if args['report']:
+        buildStats.writeReport(args['report'])
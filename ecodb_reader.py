@@ -0,0 +1,454 @@
+#!/usr/bin/env python3
+
+'''
+--------------------------------------------------------------------------------
+Read back the ecoPCR/ecoPrimers database files written by ecodb_maker.py
+
+The files are memory-mapped and records are only decoded when a field
+is asked for, following the layouts of ecoSeqPacker (.sdx),
+ecoTaxPacker (.tdx), ecoNamePacker (.ndx) and ecoRankPacker (.rdx).
+Sequence records hand out memoryviews on the map, so nothing is copied
+until a sequence is decompressed.
+
+A sidecar index (<prefix>.ecosdi) maps accessions and taxa to record
+positions, and taxids to .tdx records; it is rebuilt whenever a shard
+or the .tdx file changes.
+
+Usage:
+  ./ecodb_reader.py -d prefix count            # sequences per taxid
+  ./ecodb_reader.py -d prefix get ACC1 ACC2    # sequences as FASTA
+  ./ecodb_reader.py -d prefix taxid 9606       # sequences of a taxon
+  ./ecodb_reader.py -d prefix index            # (re)build the sidecar index
+
+--------------------------------------------------------------------------------
+'''
+
+import os
+import sys
+import glob
+import mmap
+import zlib
+import struct
+import marshal
+import argparse
+from collections import Counter
+
+#####
+#
+#
+# Record layouts
+#
+#
+#####
+
+_count     = struct.Struct('> I')
+# size, taxon row, id, definition length, sequence length, compressed length
+_seqHeader = struct.Struct('> I I 20s I I I')
+# size, taxid, rank, parent row, name length
+_taxHeader = struct.Struct('> I I I I I')
+# size, is scientific name, name length, class name length, taxon row
+_nameHeader = struct.Struct('> I I I I I')
+
+class MappedFile(object):
+    '''
+    Read-only memory map of a database file.
+    '''
+
+    def __init__(self, file):
+        self.file = file
+        with open(file, 'rb') as f:
+            self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        self._view = memoryview(self._map)
+
+    def __len__(self):
+        return _count.unpack_from(self._map, 0)[0]
+
+    def close(self):
+        self._view.release()
+        try:
+            self._map.close()
+        except BufferError:
+            # records handed out still hold views on the map, which
+            # is then unmapped when the last of them goes away
+            pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+#####
+#
+#
+# Sequences (.sdx)
+#
+#
+#####
+
+class EcoSeqRecord(object):
+    '''
+    One record of a .sdx file, decoded on demand from a view of the
+    memory map. taxon is the row of the taxon in the .tdx file, not
+    its NCBI taxid.
+    '''
+
+    __slots__ = ('_view', 'offset')
+
+    def __init__(self, view, offset):
+        self._view  = view
+        self.offset = offset
+
+    def _header(self):
+        return _seqHeader.unpack_from(self._view, 0)
+
+    @property
+    def taxon(self):
+        return self._header()[1]
+
+    @property
+    def id(self):
+        return self._header()[2].rstrip(b'\0').decode('ascii')
+
+    @property
+    def definition(self):
+        delength = self._header()[3]
+        start = _seqHeader.size
+        return self._view[start:start + delength]
+
+    @property
+    def length(self):
+        return self._header()[4]
+
+    @property
+    def compressed(self):
+        header = self._header()
+        start = _seqHeader.size + header[3]
+        return self._view[start:start + header[5]]
+
+    @property
+    def sequence(self):
+        return zlib.decompress(self.compressed)
+
+    @property
+    def packed(self):
+        return self._view
+
+class EcoSeqFile(MappedFile):
+    '''
+    A .sdx file. Iterating walks the records in order; recordAt jumps
+    to a known byte offset.
+    '''
+
+    def recordAt(self, offset):
+        size = _count.unpack_from(self._map, offset)[0]
+        return EcoSeqRecord(self._view[offset:offset + size + 4], offset)
+
+    def __iter__(self):
+        offset = _count.size
+        for i in range(len(self)):
+            record = self.recordAt(offset)
+            offset += len(record.packed)
+            yield record
+
+#####
+#
+#
+# Taxonomy (.tdx, .rdx, .ndx)
+#
+#
+#####
+
+class EcoTaxonomyFile(MappedFile):
+    '''
+    A .tdx file. Rows are located with one pass over the record sizes
+    the first time one is asked for, unless their offsets are given
+    (by the sidecar index); taxa are returned as the
+    (taxid, rank, parent, name) tuples given to ecoTaxPacker.
+    '''
+
+    def __init__(self, file, offsets=None, rows=None):
+        MappedFile.__init__(self, file)
+        self._offsets = offsets
+        self._rows = rows
+
+    def offsets(self):
+        '''
+        Offset of every record.
+        '''
+        if self._offsets is None:
+            self._offsets = []
+            offset = _count.size
+            for i in range(len(self)):
+                self._offsets.append(offset)
+                offset += _count.unpack_from(self._map, offset)[0] + 4
+        return self._offsets
+
+    def rows(self):
+        '''
+        Row of every NCBI taxid.
+        '''
+        if self._rows is None:
+            self._rows = {}
+            for row, offset in enumerate(self.offsets()):
+                self._rows[_taxHeader.unpack_from(self._map, offset)[1]] = row
+        return self._rows
+
+    def __getitem__(self, row):
+        offset = self.offsets()[row]
+        size, taxid, rank, parent, namelength = \
+            _taxHeader.unpack_from(self._map, offset)
+        start = offset + _taxHeader.size
+        return taxid, rank, parent, self._map[start:start + namelength]
+
+    def __iter__(self):
+        for row in range(len(self)):
+            yield self[row]
+
+    def rowOf(self, taxid):
+        '''
+        Row of an NCBI taxid, or None when it is not in the file.
+        '''
+        return self.rows().get(taxid)
+
+def readRanks(file):
+    '''
+    Rank names of a .rdx file, in rank code order.
+    '''
+    with open(file, 'rb') as f:
+        data = f.read()
+    ranks = []
+    offset = _count.size
+    for i in range(_count.unpack_from(data, 0)[0]):
+        length = _count.unpack_from(data, offset)[0]
+        offset += 4
+        ranks.append(data[offset:offset + length])
+        offset += length
+    return ranks
+
+class EcoNameFile(MappedFile):
+    '''
+    A .ndx file, iterated as (name, classname, taxon row) tuples like
+    the ones given to ecoNamePacker.
+    '''
+
+    def __iter__(self):
+        offset = _count.size
+        for i in range(len(self)):
+            size, scientific, namelength, classlength, row = \
+                _nameHeader.unpack_from(self._map, offset)
+            start = offset + _nameHeader.size
+            name = self._map[start:start + namelength]
+            classname = self._map[start + namelength:
+                                  start + namelength + classlength]
+            yield name, classname, row
+            offset += size + 4
+
+#####
+#
+#
+# Whole database
+#
+#
+#####
+
+SEQ_INDEX_VERSION = 2
+
+class EcoDatabase(object):
+    '''
+    An ecoPCR database: prefix.tdx, prefix.rdx, prefix.ndx and the
+    prefix_NNN.sdx shards.
+    '''
+
+    def __init__(self, prefix):
+        self.prefix = prefix
+        self.shardNames = sorted(glob.glob('%s_[0-9][0-9][0-9].sdx' % prefix))
+        if not self.shardNames:
+            raise ValueError('no .sdx file for database %s' % prefix)
+        self.shards = [EcoSeqFile(name) for name in self.shardNames]
+        self._taxonomy = None
+        self._index = None
+
+    @property
+    def taxonomy(self):
+        if self._taxonomy is None:
+            self._taxonomy = EcoTaxonomyFile(self.taxonomyName())
+        return self._taxonomy
+
+    def taxonomyName(self):
+        return '%s.tdx' % self.prefix
+
+    def ranks(self):
+        return readRanks('%s.rdx' % self.prefix)
+
+    def names(self):
+        return EcoNameFile('%s.ndx' % self.prefix)
+
+    def __len__(self):
+        return sum(len(shard) for shard in self.shards)
+
+    def __iter__(self):
+        for shard in self.shards:
+            for record in shard:
+                yield record
+
+    def countByTaxon(self):
+        '''
+        Number of sequences per NCBI taxid.
+        '''
+        taxonomy = self.taxonomy
+        rows = Counter(record.taxon for record in self)
+        return Counter(dict((taxonomy[row][0], count)
+                            for row, count in rows.items()))
+
+    # sidecar index
+
+    def indexName(self):
+        return '%s.ecosdi' % self.prefix
+
+    def _shardStamps(self):
+        stamps = []
+        for name in self.shardNames + [self.taxonomyName()]:
+            st = os.stat(name)
+            stamps.append((os.path.basename(name), st.st_size, st.st_mtime_ns))
+        return stamps
+
+    def buildIndex(self, save=True):
+        '''
+        Map every accession to its (shard, offset) and every taxon row
+        to the list of its records; the .tdx record offsets and the
+        row of every taxid are saved along.
+        '''
+        ids  = {}
+        taxa = {}
+        for number, shard in enumerate(self.shards):
+            for record in shard:
+                position = (number, record.offset)
+                ids[record.id] = position
+                taxa.setdefault(record.taxon, []).append(position)
+        self._index = ids, taxa
+        if save:
+            index = {'version': SEQ_INDEX_VERSION,
+                     'shards' : self._shardStamps(),
+                     'ids'    : ids,
+                     'taxa'   : taxa,
+                     'taxonOffsets': self.taxonomy.offsets(),
+                     'taxonRows'   : self.taxonomy.rows()}
+            tmp = '%s.%d.tmp' % (self.indexName(), os.getpid())
+            with open(tmp, 'wb') as output:
+                marshal.dump(index, output)
+            os.rename(tmp, self.indexName())
+        return self._index
+
+    def _loadIndex(self):
+        try:
+            with open(self.indexName(), 'rb') as f:
+                index = marshal.load(f)
+        except (IOError, EOFError, ValueError, TypeError):
+            return None
+        if (index.get('version') != SEQ_INDEX_VERSION or
+            index.get('shards') != self._shardStamps()):
+            return None
+        if self._taxonomy is None:
+            self._taxonomy = EcoTaxonomyFile(self.taxonomyName(),
+                                             index['taxonOffsets'],
+                                             index['taxonRows'])
+        return index['ids'], index['taxa']
+
+    def index(self):
+        '''
+        The sidecar index, loaded or rebuilt as needed.
+        '''
+        if self._index is None:
+            self._index = self._loadIndex()
+        if self._index is None:
+            self.buildIndex()
+        return self._index
+
+    def _record(self, position):
+        number, offset = position
+        return self.shards[number].recordAt(offset)
+
+    def get(self, id):
+        '''
+        The record of an accession, or None.
+        '''
+        position = self.index()[0].get(id)
+        if position is None:
+            return None
+        return self._record(position)
+
+    def sequencesOfTaxid(self, taxid):
+        '''
+        Records attached directly to an NCBI taxid.
+        '''
+        # the index first, as it saves scanning the .tdx file
+        positions = self.index()[1]
+        row = self.taxonomy.rowOf(taxid)
+        if row is None:
+            return []
+        return [self._record(p) for p in positions.get(row, [])]
+
+    def close(self):
+        for shard in self.shards:
+            shard.close()
+        if self._taxonomy is not None:
+            self._taxonomy.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+def writeFasta(records, output):
+    for record in records:
+        output.write('>%s %s\n' % (record.id,
+                                   bytes(record.definition).decode('latin-1')))
+        sequence = record.sequence.decode('ascii')
+        for i in range(0, len(sequence), 60):
+            output.write(sequence[i:i + 60] + '\n')
+
+parser = argparse.ArgumentParser(
+  description = 'Inspect a database made by ecodb_maker.py')
+
+parser.add_argument('-d', '--database',
+  help = 'database prefix, as given to ecodb_maker.py --output',
+  required = True)
+
+parser.add_argument('command',
+  choices = ['count', 'get', 'taxid', 'index'],
+  help = 'count: sequences per taxid; get: sequences by accession; '
+         'taxid: sequences of taxids; index: rebuild the sidecar index')
+
+parser.add_argument('keys', nargs = '*',
+  help = 'accessions for get, taxids for taxid')
+
+if __name__ == '__main__':
+
+    args = parser.parse_args()
+
+    try:
+        with EcoDatabase(args.database) as db:
+            if args.command == 'count':
+                for taxid, count in sorted(db.countByTaxon().items()):
+                    sys.stdout.write('%d\t%d\n' % (taxid, count))
+            elif args.command == 'get':
+                records = [db.get(key) for key in args.keys]
+                missing = [key for key, r in zip(args.keys, records)
+                           if r is None]
+                writeFasta([r for r in records if r is not None], sys.stdout)
+                if missing:
+                    sys.stderr.write('Not found: %s\n' % ' '.join(missing))
+            elif args.command == 'taxid':
+                for key in args.keys:
+                    writeFasta(db.sequencesOfTaxid(int(key)), sys.stdout)
+            elif args.command == 'index':
+                db.buildIndex()
+                sys.stderr.write('Index written to %s\n' % db.indexName())
+    except BrokenPipeError:
+        # the reader of the output went away, as with | head; stdout is
+        # pointed at /dev/null so that flushing it at exit is quiet
+        devnull = os.open(os.devnull, os.O_WRONLY)
+        os.dup2(devnull, sys.stdout.fileno())
+        sys.exit(1)
@@ -0,0 +1,365 @@
+#!/usr/bin/env python3
+
+'''
+--------------------------------------------------------------------------------
+Filter the primer pairs found by ecoPrimers (port of ecoprimer_filter.R)
+
+The ecoPrimers table (21 columns separated by '|', or by whitespace;
+lines starting with # are skipped) is read by chunks of rows into
+columnar numpy arrays, and every threshold is applied to a whole
+chunk at once as a boolean mask. Kept pairs are written to
+<table minus extension>_filt.csv and their primers, without
+duplicates, to <table minus extension>_primers.fasta, as the R script
+did.
+
+The defaults are the thresholds of the R script: barcode lengths
+(columns 19-21) between 70 and 150, primer G+C between 40% and 60%,
+no base repeated more than 4 times in a row, every Tm between 50 and
+65, Tm of the two primers within 2 degrees of each other, and both
+primers good (GG).
+
+Primer-dimers, hairpins and nearest-neighbor Tm (primer_thermo.py)
+are only checked when asked for, on the pairs that pass the other
+filters.
+
+Usage:
+  ./ecoprimer_filter.py ecoprimers_output.tsv
+  ./ecoprimer_filter.py ecoprimers_output.tsv --tm-min 55 --amplicon-min 30
+  ./ecoprimer_filter.py ecoprimers_output.tsv --dimer-dg -6 --hairpin-dg -2
+
+--------------------------------------------------------------------------------
+'''
+
+import os
+import sys
+import csv
+import argparse
+
+import numpy as np
+
+from primer_thermo import NearestNeighbor, SALT_CONC
+
+#####
+#
+#
+# Filters
+#
+#
+#####
+
+# All of them take numpy arrays and return a boolean array: True for
+# the rows that pass. Sequences are arrays of bytes (dtype 'S').
+
+def primer_length(x, min=18, max=30):
+    length = np.char.str_len(x)
+    return (length > min) & (length < max)
+
+def amplicon_length(x, min=70, max=150):
+    length = np.char.str_len(x)
+    return (length > min) & (length < max)
+
+def gc_content(gc_count, primer_len, min=0.4, max=0.6):
+    gc_prop = gc_count / primer_len
+    return (gc_prop >= min) & (gc_prop <= max)
+
+def _bytes_matrix(x):
+    '''
+    The sequences of x as rows of a uint8 matrix, padded with zeros.
+    '''
+    x = np.ascontiguousarray(x, dtype=bytes)
+    width = max(x.dtype.itemsize, 1)
+    return np.frombuffer(x.tobytes(), dtype=np.uint8).reshape(len(x), width)
+
+# the characters matched by \w in the R regex
+_word = np.zeros(256, dtype=bool)
+for _c in b'0123456789ABCDEFGHIJKLMNOPQRSTUVWXYZ_abcdefghijklmnopqrstuvwxyz':
+    _word[_c] = True
+
+def repeats(x, max=4):
+    '''
+    False for the sequences where a character occurs more than max
+    times in a row, like !grepl('(\\w)\\1{max,}', x).
+    '''
+    chars = _bytes_matrix(x)
+    # run[:, i]: length of the run of identical characters ending at i
+    run = _word[chars].astype(np.int32)
+    for i in range(1, chars.shape[1]):
+        same = (chars[:, i] == chars[:, i - 1]) & (run[:, i] > 0)
+        run[:, i] += np.where(same, run[:, i - 1], 0)
+    return ~(run > max).any(axis=1)
+
+def melt_temp(x, min=50, max=65):
+    return (x >= min) & (x <= max)
+
+def melt_temp_diff(x, y, max=2):
+    return np.abs(x - y) <= max
+
+def test(x):
+    if not x:
+        raise AssertionError('test failed!')
+
+def self_test():
+    '''
+    The checks of the R script, run before every filtering.
+    '''
+    seqs = np.array([b'A' * n for n in range(1, 201)])
+    test(list(np.flatnonzero(primer_length(seqs)) + 1) == list(range(19, 30)))
+    test(list(np.flatnonzero(amplicon_length(seqs)) + 1) ==
+         list(range(71, 150)))
+    test(list(np.flatnonzero(gc_content(np.arange(1, 21), 20)) + 1) ==
+         list(range(8, 13)))
+    mystrings = np.array([b'atcg', b'aychaydgg', b'diehkaaa', b'djhfossss',
+                          b'fjrndttttt', b'ggggggsjfiejcndjskeid'])
+    test(list(np.flatnonzero(repeats(mystrings)) + 1) == [1, 2, 3, 4])
+    test(list(np.flatnonzero(melt_temp(np.arange(1, 101))) + 1) ==
+         list(range(50, 66)))
+    test(list(np.flatnonzero(melt_temp_diff(np.full(10, 5),
+                                            np.arange(1, 11))) + 1) ==
+         [3, 4, 5, 6, 7])
+
+#####
+#
+#
+# ecoPrimers table
+#
+#
+#####
+
+# ------------------------------------------
+# Table result description :
+# column  1 : serial number
+# column  2 : primer1
+# column  3 : primer2
+# column  4 : primer1 Tm without mismatch
+# column  5 : primer1 lowest Tm against exemple sequences
+# column  6 : primer2 Tm without mismatch
+# column  7 : primer2 lowest Tm against exemple sequences
+# column  8 : primer1 G+C count
+# column  9 : primer2 G+C count
+# column 10 : good/bad
+# column 11 : amplified example sequence count
+# column 12 : amplified counterexample sequence count
+# column 13 : yule
+# column 14 : amplified example taxa count
+# column 15 : amplified counterexample taxa count
+# column 16 : ratio of amplified example taxa versus all example taxa (Bc index)
+# column 17 : unambiguously identified example taxa count
+# column 18 : ratio of specificity unambiguously identified example taxa versus all example taxa (Bs index)
+# column 19 : minimum amplified length
+# column 20 : maximum amplified length
+# column 21 : average amplified length
+# ------------------------------------------
+
+COLUMNS = 21
+
+def _split_rows(lines, first):
+    # the whole chunk is split at once; no field holds blanks, so with
+    # '|' they can all go and line ends become separators
+    if b'|' in lines[0]:
+        fields = b''.join(lines).translate(None, b' \t\r')
+        fields = fields.replace(b'\n', b'|').split(b'|')[:-1]
+        split = lambda line: line.translate(None, b' \t\r\n').split(b'|')
+    else:
+        fields = b''.join(lines).split()
+        split = lambda line: line.split()
+    if len(fields) != COLUMNS * len(lines):
+        for i, line in enumerate(lines):
+            if len(split(line)) != COLUMNS:
+                raise ValueError('row %d has %d columns instead of %d' %
+                                 (first + i + 1, len(split(line)), COLUMNS))
+    return np.array(fields, dtype=bytes).reshape(len(lines), COLUMNS)
+
+def read_table(file, chunksize=1 << 16):
+    '''
+    Yield the rows of an ecoPrimers table as arrays of chunksize rows
+    by 21 columns of bytes.
+    '''
+    lines = []
+    count = 0
+    with open(file, 'rb') as input:
+        for line in input:
+            if line.startswith(b'#') or not line.strip():
+                continue
+            lines.append(line)
+            if len(lines) == chunksize:
+                yield _split_rows(lines, count)
+                count += len(lines)
+                lines = []
+    if lines:
+        yield _split_rows(lines, count)
+
+def column(table, number, type=float):
+    '''
+    Column number (counted from 1, like V1..V21) of a chunk.
+    '''
+    return table[:, number - 1].astype(type)
+
+def filter_table(table, primer_len, args, thermo=None):
+    '''
+    Mask of the rows of a chunk that pass every filter; thermo, a
+    primer_thermo.NearestNeighbor, is needed for --nn-tm, --dimer-dg
+    and --hairpin-dg.
+    '''
+    keep = np.ones(len(table), dtype=bool)
+    for number in (19, 20, 21):
+        size = column(table, number)
+        keep &= (size >= args.amplicon_min) & (size <= args.amplicon_max)
+    for number in (8, 9):
+        keep &= gc_content(column(table, number), primer_len,
+                           args.gc_min, args.gc_max)
+    for number in (2, 3):
+        keep &= repeats(table[:, number - 1], args.max_repeat)
+        if args.primer_min is not None or args.primer_max is not None:
+            keep &= primer_length(table[:, number - 1],
+                                  args.primer_min or 0,
+                                  args.primer_max or sys.maxsize)
+    tm = dict((number, column(table, number)) for number in (4, 5, 6, 7))
+    if args.nn_tm:
+        # only for the pairs still kept, the others stay nan and fail
+        rows = np.flatnonzero(keep)
+        tm[4] = np.full(len(table), np.nan)
+        tm[6] = np.full(len(table), np.nan)
+        tm[4][rows] = thermo.tm(table[rows, 1])
+        tm[6][rows] = thermo.tm(table[rows, 2])
+    for number in (4, 5, 6, 7):
+        keep &= melt_temp(tm[number], args.tm_min, args.tm_max)
+    keep &= melt_temp_diff(tm[4], tm[6], args.tm_diff)
+    keep &= melt_temp_diff(tm[5], tm[7], args.tm_diff)
+    keep &= table[:, 9] == b'GG'
+    if args.dimer_dg is not None or args.hairpin_dg is not None:
+        rows = np.flatnonzero(keep)
+        keep[rows] = thermo_filter(table[rows, 1], table[rows, 2],
+                                   thermo, args)
+    return keep
+
+def thermo_filter(primers1, primers2, thermo, args):
+    '''
+    Pairs whose primers form no hairpin and no 3' dimer (with itself or
+    the other primer) more stable than the given free energies.
+    '''
+    keep = np.ones(len(primers1), dtype=bool)
+    if args.hairpin_dg is not None:
+        keep &= thermo.hairpin(primers1) >= args.hairpin_dg
+        keep &= thermo.hairpin(primers2) >= args.hairpin_dg
+    if args.dimer_dg is not None:
+        keep &= thermo.self_dimer(primers1) >= args.dimer_dg
+        keep &= thermo.self_dimer(primers2) >= args.dimer_dg
+        rows = np.flatnonzero(keep)
+        keep[rows] = thermo.pair_dimer(primers1[rows],
+                                       primers2[rows]) >= args.dimer_dg
+    return keep
+
+def write_fasta(primers, outfile):
+    '''
+    Write the primers as primer-001, primer-002, ...
+    '''
+    with open(outfile, 'w') as output:
+        for i, primer in enumerate(primers):
+            output.write('>primer-%03d\n%s\n' % (i + 1, primer))
+
+def unique(values):
+    '''
+    values without duplicates, in the order of first occurrence.
+    '''
+    return list(dict.fromkeys(values))
+
+parser = argparse.ArgumentParser(
+  description = 'Filter the primer pairs found by ecoPrimers')
+
+parser.add_argument('table',
+  help = 'ecoPrimers output (e.g. from ecoprimer_wrap.sh)')
+
+parser.add_argument('--amplicon-min', type = float, default = 70,
+  help = 'smallest minimum, maximum and average barcode length (default: 70)')
+
+parser.add_argument('--amplicon-max', type = float, default = 150,
+  help = 'largest minimum, maximum and average barcode length (default: 150)')
+
+parser.add_argument('--gc-min', type = float, default = 0.4,
+  help = 'lowest G+C proportion of each primer (default: 0.4)')
+
+parser.add_argument('--gc-max', type = float, default = 0.6,
+  help = 'highest G+C proportion of each primer (default: 0.6)')
+
+parser.add_argument('--max-repeat', type = int, default = 4,
+  help = 'longest run of one base allowed in a primer (default: 4)')
+
+parser.add_argument('--tm-min', type = float, default = 50,
+  help = 'lowest Tm of each primer, with and without mismatches '
+         '(default: 50)')
+
+parser.add_argument('--tm-max', type = float, default = 65,
+  help = 'highest Tm of each primer (default: 65)')
+
+parser.add_argument('--tm-diff', type = float, default = 2,
+  help = 'largest Tm difference between the two primers (default: 2)')
+
+parser.add_argument('--primer-min', type = int,
+  help = 'primers must be longer than this (not checked by default)')
+
+parser.add_argument('--primer-max', type = int,
+  help = 'primers must be shorter than this (not checked by default)')
+
+parser.add_argument('--nn-tm', action = 'store_true',
+  help = 'check the Tm thresholds on the nearest-neighbor Tm of the primers '
+         'instead of columns 4 and 6')
+
+parser.add_argument('--dimer-dg', type = float,
+  help = 'reject pairs with a 3\' self- or cross-dimer more stable than '
+         'this free energy, in kcal/mol, e.g. -6 (not checked by default)')
+
+parser.add_argument('--hairpin-dg', type = float,
+  help = 'reject pairs with a primer folding in a 3\' hairpin more stable '
+         'than this free energy, in kcal/mol, e.g. -2 (not checked by '
+         'default)')
+
+parser.add_argument('--salt', type = float, default = SALT_CONC,
+  help = 'salt concentration in M for --nn-tm, --dimer-dg and '
+         '--hairpin-dg (default: %g, as in ecoprimer_wrap.sh)' % SALT_CONC)
+
+parser.add_argument('-f', '--force', action = 'store_true',
+  help = 'overwrite the primer FASTA file when it already exists')
+
+if __name__ == '__main__':
+
+    args = parser.parse_args()
+
+    self_test()
+
+    base = os.path.splitext(args.table)[0]
+    primer_file = base + '_primers.fasta'
+    outfile = base + '_filt.csv'
+    if os.path.exists(primer_file) and not args.force:
+        parser.error('fasta file already exists! (%s; use --force to '
+                     'overwrite it)' % primer_file)
+
+    # one for the whole table, which keeps the values of every primer
+    thermo = NearestNeighbor(args.salt)
+
+    rows = 0
+    primers1 = []
+    primers2 = []
+    primer_len = None
+    with open(outfile, 'w', newline = '') as output:
+        writer = csv.writer(output, lineterminator = '\n')
+        writer.writerow(['V%d' % (i + 1) for i in range(COLUMNS)])
+        try:
+            for table in read_table(args.table):
+                if primer_len is None:
+                    # ecoPrimers primers all have the length given with -O
+                    primer_len = len(table[0, 1])
+                rows += len(table)
+                kept = table[filter_table(table, primer_len, args, thermo)]
+                writer.writerows([field.decode('ascii') for field in row]
+                                 for row in kept)
+                primers1.extend(kept[:, 1].tolist())
+                primers2.extend(kept[:, 2].tolist())
+        except ValueError as e:
+            parser.error('%s: %s' % (args.table, e))
+
+    primers = unique(p.decode('ascii') for p in primers1 + primers2)
+    write_fasta(primers, primer_file)
+
+    sys.stderr.write('%d of %d primer pairs kept (%s), %d primers written '
+                     'to %s\n' % (len(primers1), rows, outfile,
+                                  len(primers), primer_file))
@@ -11,10 +11,35 @@ Downloading a set of DNA sequences from NCBI's nucleotide database (also known a
 
 2. Download each of the sequences in that list.
 
-For the first step, we use Bio.Entrez.esearch(); for the second, Bio.Entrez.efetch()
+For the first step, we use esearch; for the second, efetch.
 
 Looping over sequences for the download portion would put undo strain on NCBI's servers; therefore it is recommended to get the list of sequences, leave the list on their server, and reference that to download sequences.
-To do this, call Bio.Entrez.esearch() as normal, but with the additional argument of usehistory="y"
+To do this, call esearch with the additional argument usehistory="y".
+
+The batches are then fetched by a small pool of threads that share a
+token bucket, so that together they never go over NCBI's limit of 3
+requests per second (10 with an API key). Each batch is written to its
+own temporary file and the files are appended to the output in order.
+Use --eutils-url to point the script at another (e.g. a local mock) server.
+
+Every batch is checked (its number of records must match what was
+asked for) before it is appended, and the appended batches are logged
+in a journal (<output>.journal) together with the search session and
+their byte range in the output. If a run dies, start it again with the
+same --output and --resume to carry on after the last good batch. The
+journal also keeps a digest of the accessions the search found, and a
+download is only resumed if the search still finds the same ones.
+
+With --cache DIR, records are kept in a local store keyed by
+accession.version. The full list of matching accessions is fetched
+with esearch, only the ones missing from the store are downloaded
+(by ID), and the output is assembled from the store. Overlapping
+queries then only cost the records that are actually new, and an
+interrupted run simply picks up what is already cached.
+
+With --output -, the records go to standard output as each batch
+completes (and messages to standard error), so they can be piped
+straight into ecodb_maker.py -i - without a GenBank file on disk.
 
 TODO:
   - query file:
@@ -24,149 +49,598 @@ TODO:
     - example: "organism", "exclude", "neoditrema"
 '''
 
-# you will need these packages:
 from datetime import datetime
-from Bio import Entrez
+import os
 import sys
+import json
+import time
+import shutil
+import hashlib
+import tempfile
 import argparse
-
-parser = argparse.ArgumentParser(description = 
+import threading
+import http.client
+from concurrent.futures import ThreadPoolExecutor
+from urllib.error import HTTPError
+from urllib.parse import urlencode
+from urllib.request import urlopen
+
+parser = argparse.ArgumentParser(description =
     'Download sequences from NCBI database nt ("GenBank")')
 
 parser.add_argument('-e', '--email',
-  help = 'An email address at which NCBI can contact you in case of overuse.', 
+  help = 'An email address at which NCBI can contact you in case of overuse.',
   required = False)
 
 parser.add_argument('-q', '--query',
-  help = 'String of search terms, e.g. "Homo sapiens"[Organism]', 
+  help = 'String of search terms, e.g. "Homo sapiens"[Organism]',
   required = False)
 
 parser.add_argument('-f', '--format',
-  choices=['gb', 'fasta'], default = "gb", 
-  help = 'Output format (genbank or fasta). Use gb for ecoprimers.', 
+  choices=['gb', 'fasta'], default = "gb",
+  help = 'Output format (genbank or fasta). Use gb for ecoprimers.',
   required = False)
 
 parser.add_argument('-o', '--output',
-  help = 'Base name for output without extension. ex: oophaga_16s ', 
+  help = 'Base name for output without extension. ex: oophaga_16s '
+         'Use - to write the records to standard output.',
   required = False)
 
-args = vars(parser.parse_args())
-
-# args will be a dictionary containing the arguments:
+parser.add_argument('-y', '--yes',
+  action = 'store_true',
+  help = 'Download without asking for confirmation.')
 
-if args['email'] is None:
-    # you MUST enter an email address:
-    print('You must enter an email address. NCBI will contact you in case of overuse.')
-    Entrez.email = input("email: ")
-else:
-    Entrez.email = args['email']
+parser.add_argument('-k', '--api-key',
+  help = 'NCBI API key; raises the request rate limit from 3 to 10 per second.',
+  required = False)
 
-if args['query'] is None:
-    print('Enter a search query, for example:' + '\n' + 
-    '"Poecilia wingei"[Organism] AND gene_in_mitochondrion[PROP] AND 100:1000[SLEN]')
-    my_query = input()
-    if len(my_query) < 1:
-        print("No query entered. For help, use argument -h.")
-        sys.exit()
-else:
-    my_query = args['query']
+parser.add_argument('-b', '--batch-size',
+  type = int, default = 100,
+  help = 'Number of records per efetch request (default: 100).')
 
-# Example queries:
-# my_query = '"Embiotocidae"[organism] AND gene_in_mitochondrion[PROP] AND ("cytochrome b") NOT ("COI")'
-# my_query = '"Poecilia wingei"[Organism]'
-# my_query = '"Boraras brigittae"[Organism]'
-# my_query = '"Oophaga pumilio"[Organism] AND ("cytochrome"[ALL] NOT "cytochrome b"[ALL])'
+parser.add_argument('-j', '--jobs',
+  type = int, default = 3,
+  help = 'Number of batches downloaded at the same time (default: 3).')
 
-outfile_format = args['format']
+parser.add_argument('--resume',
+  action = 'store_true',
+  help = 'Continue an interrupted download of --output from its journal.')
 
-start_time = datetime.now()
-start_time_fmt = start_time.strftime('%y%m%d-%H%M%S')
+parser.add_argument('-c', '--cache',
+  help = 'Directory of the local record cache; only records missing from '
+         'it are downloaded.')
 
-if args['output'] is None:
-    outfile_base  = 'gbdl' + '_' + start_time_fmt
-else:
-    outfile_base = args['output']
+parser.add_argument('--rate',
+  type = float,
+  help = 'Maximum requests per second (default: 3, or 10 with an API key).')
 
-outfile_path  = outfile_base + '.' + outfile_format
-metadata_path = outfile_base + '.md'
+parser.add_argument('--timeout',
+  type = float, default = 120,
+  help = 'Seconds without an answer from the server before a request is '
+         'retried (default: 120).')
 
-# database can be either 'nucleotide' or others, 
+# database can be either 'nucleotide' or others,
 # this should probably not be modified by the user of this script
 ncbi_db = "nucleotide"
 
-search_handle = Entrez.esearch(db = ncbi_db, usehistory = "y", retmax=200, 
-    term = my_query)
-search_results = Entrez.read(search_handle)
-search_handle.close()
-
-
-# When you get the XML output back, it will still include the usual search results:
-gi_list = search_results["IdList"]
-count = int(search_results["Count"])
-
-print("Found " + str(count) + " records. Do you want to download all of them?")
-download = input('[y|n]: ')
-if not any(y in download for y in ["y", "Y"]):
-    print('Aborting.')
+eutils_url = 'https://eutils.ncbi.nlm.nih.gov/entrez/eutils/'
+
+parser.add_argument('--eutils-url',
+  default = eutils_url,
+  help = 'Base URL of the E-utilities (default: NCBI).')
+
+class TokenBucket(object):
+    '''
+    Thread-safe token bucket: acquire() blocks until one of `rate`
+    tokens per second is available, with at most `burst` saved up.
+    '''
+
+    def __init__(self, rate, burst=1):
+        self.rate = rate
+        self.burst = burst
+        self._tokens = burst
+        self._last = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(self.burst,
+                                   self._tokens + (now - self._last) * self.rate)
+                self._last = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                wait = (1 - self._tokens) / self.rate
+            time.sleep(wait)
+
+class Eutils(object):
+    '''
+    Minimal E-utilities client. Every request, retries included, takes
+    a token from the shared bucket. Server errors (5XX), 429 and network
+    errors, dropped connections and timeouts included, are retried
+    `attempts` times with a growing pause.
+    '''
+
+    def __init__(self, email, api_key=None, rate=None, url=eutils_url,
+                 attempts=3, pause=15, timeout=120):
+        if rate is None:
+            rate = 10 if api_key else 3
+        self.base_url = url
+        self.params = {'tool': 'get_genbank', 'email': email}
+        if api_key:
+            self.params['api_key'] = api_key
+        self.bucket = TokenBucket(rate)
+        self.attempts = attempts
+        self.pause = pause
+        self.timeout = timeout
+
+    def request(self, utility, **params):
+        data = dict(self.params)
+        data.update(params)
+        data = urlencode(data).encode('ascii')
+        url = self.base_url.rstrip('/') + '/' + utility + '.fcgi'
+        for attempt in range(1, self.attempts + 1):
+            self.bucket.acquire()
+            try:
+                with urlopen(url, data, timeout=self.timeout) as response:
+                    return response.read()
+            except HTTPError as err:
+                if not (500 <= err.code <= 599 or err.code == 429):
+                    raise
+                error = err
+            # URLError and socket.timeout are OSErrors; RemoteDisconnected
+            # and IncompleteRead come unwrapped from http.client
+            except (http.client.HTTPException, OSError) as err:
+                error = err
+            print("Received error from server %s" % error)
+            print("Attempt %i of %i" % (attempt, self.attempts))
+            if attempt < self.attempts:
+                time.sleep(self.pause * attempt)
+        raise error
+
+    def esearch(self, term, **params):
+        reply = self.request('esearch', db=ncbi_db, term=term,
+                             retmode='json', **params)
+        return json.loads(reply.decode('utf-8'))['esearchresult']
+
+    def efetch(self, **params):
+        return self.request('efetch', db=ncbi_db, retmode='text', **params)
+
+class BatchError(Exception):
+    pass
+
+def count_records(data, outfile_format):
+    '''
+    Number of complete records in a batch: '//' terminators for
+    GenBank, '>' header lines for FASTA.
+    '''
+    if outfile_format == 'fasta':
+        return data.count(b'\n>') + data.startswith(b'>')
+    return data.count(b'\n//\n') + data.startswith(b'//\n')
+
+class Journal(object):
+    '''
+    Download journal, saved as JSON after every batch appended to the
+    output. It holds the query, the search session, a digest of the
+    accessions found (see ids_digest) and, for each batch, its retstart,
+    record count and byte range in the output file.
+    '''
+
+    def __init__(self, path, state):
+        self.path = path
+        self.state = state
+
+    @classmethod
+    def create(cls, path, query, outfile_format, count, batch_size,
+               webenv, query_key, ids_digest):
+        journal = cls(path, {'query': query,
+                             'format': outfile_format,
+                             'count': count,
+                             'ids_digest': ids_digest,
+                             'batch_size': batch_size,
+                             'webenv': webenv,
+                             'query_key': query_key,
+                             'batches': []})
+        journal.save()
+        return journal
+
+    @classmethod
+    def load(cls, path):
+        with open(path) as f:
+            return cls(path, json.load(f))
+
+    def save(self):
+        tmp = self.path + '.tmp'
+        with open(tmp, 'w') as f:
+            json.dump(self.state, f, indent=1)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, self.path)
+
+    def commit(self, retstart, records, offset, length):
+        self.state['batches'].append({'retstart': retstart,
+                                      'records': records,
+                                      'offset': offset,
+                                      'length': length})
+        self.save()
+
+    def next_start(self):
+        if not self.state['batches']:
+            return 0
+        last = self.state['batches'][-1]
+        return last['retstart'] + last['records']
+
+    def output_size(self):
+        if not self.state['batches']:
+            return 0
+        last = self.state['batches'][-1]
+        return last['offset'] + last['length']
+
+    def remove(self):
+        os.remove(self.path)
+
+def download_batches(eutils, count, webenv, query_key, outfile_format,
+                     out_handle, batch_size=100, jobs=3, first=0,
+                     journal=None, workdir=None):
+    '''
+    Fetch records first..count of a history-server query in batches of
+    batch_size, `jobs` at a time. Each batch goes to a temporary file;
+    the files are appended to out_handle in order and removed as soon
+    as the batches before them have been written.
+
+    A batch that does not hold the expected number of records is
+    fetched again, up to eutils.attempts times. With a journal, every
+    batch is flushed to disk and then recorded as committed.
+    '''
+    starts = list(range(first, count, batch_size))
+    # by default a fixed name, so that an interrupted run leaves nothing
+    # behind once it has been resumed
+    if workdir is None:
+        workdir = out_handle.name + '.parts'
+    os.makedirs(workdir, exist_ok=True)
+
+    def fetch(start):
+        end = min(count, start + batch_size)
+        print("Downloading record %i to %i..." % (start + 1, end))
+        for attempt in range(1, eutils.attempts + 1):
+            data = eutils.efetch(rettype=outfile_format, retstart=start,
+                                 retmax=batch_size, webenv=webenv,
+                                 query_key=query_key)
+            records = count_records(data, outfile_format)
+            if records == end - start:
+                break
+            print("Batch %i to %i holds %i records instead of %i" %
+                  (start + 1, end, records, end - start))
+            if attempt == eutils.attempts:
+                raise BatchError('could not download records %i to %i' %
+                                 (start + 1, end))
+        path = os.path.join(workdir, '%010d' % start)
+        with open(path, 'wb') as f:
+            f.write(data)
+        return start, records, path
+
+    try:
+        with ThreadPoolExecutor(max_workers=jobs) as pool:
+            # keep a bounded window of batches in flight, and write them
+            # out strictly in order
+            window = max(1, jobs) * 4
+            pending = [pool.submit(fetch, start) for start in starts[:window]]
+            following = iter(starts[window:])
+            while pending:
+                start, records, path = pending.pop(0).result()
+                if journal is not None:
+                    offset = out_handle.tell()
+                with open(path, 'rb') as f:
+                    shutil.copyfileobj(f, out_handle)
+                os.remove(path)
+                out_handle.flush()
+                if journal is not None:
+                    os.fsync(out_handle.fileno())
+                    journal.commit(start, records, offset,
+                                   out_handle.tell() - offset)
+                start = next(following, None)
+                if start is not None:
+                    pending.append(pool.submit(fetch, start))
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+#-------------------------------------------------------------------------------
+# Local record cache
+#-------------------------------------------------------------------------------
+
+def split_records(data, outfile_format):
+    '''
+    Split efetch output into (accession.version, record) pairs. GenBank
+    records are keyed by their VERSION line, FASTA records by the first
+    word of their header.
+    '''
+    records = []
+    if outfile_format == 'fasta':
+        for chunk in data.split(b'\n>'):
+            chunk = chunk.strip(b'\n')
+            if not chunk:
+                continue
+            if not chunk.startswith(b'>'):
+                chunk = b'>' + chunk
+            accession = chunk[1:].split(None, 1)[0]
+            records.append((accession.decode('ascii'), chunk + b'\n'))
+    else:
+        for chunk in data.split(b'\n//\n'):
+            chunk = chunk.strip(b'\n')
+            if not chunk:
+                continue
+            accession = None
+            for line in chunk.split(b'\n'):
+                if line.startswith(b'VERSION'):
+                    accession = line.split()[1].decode('ascii')
+                    break
+            if accession is not None:
+                records.append((accession, chunk + b'\n//\n'))
+    return records
+
+class RecordCache(object):
+    '''
+    Records stored one per file under root/<format>/<xx>/<accession>,
+    where xx is taken from the hash of the accession.version so that no
+    directory grows too large.
+    '''
+
+    def __init__(self, root, outfile_format):
+        self.root = os.path.join(root, outfile_format)
+        self.outfile_format = outfile_format
+
+    def path(self, accession):
+        bucket = hashlib.sha1(accession.encode('ascii')).hexdigest()[:2]
+        return os.path.join(self.root, bucket, accession)
+
+    def __contains__(self, accession):
+        return os.path.exists(self.path(accession))
+
+    def put(self, accession, record):
+        path = self.path(accession)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp = '%s.%d.%d.tmp' % (path, os.getpid(), threading.get_ident())
+        with open(tmp, 'wb') as f:
+            f.write(record)
+        os.replace(tmp, path)
+
+    def assemble(self, accessions, out_handle):
+        for accession in accessions:
+            with open(self.path(accession), 'rb') as f:
+                shutil.copyfileobj(f, out_handle)
+            if self.outfile_format != 'fasta':
+                out_handle.write(b'\n')
+            out_handle.flush()
+
+def search_ids(eutils, term, page=10000):
+    '''
+    Every accession.version matched by a query, in esearch order.
+    '''
+    ids = []
+    start = 0
+    while True:
+        result = eutils.esearch(term, idtype='acc', retstart=start, retmax=page)
+        ids.extend(result['idlist'])
+        start += page
+        if start >= int(result['count']):
+            return ids
+
+def ids_digest(ids):
+    '''
+    SHA-1 of the accessions found by a search, in esearch order, which
+    is the order the batches are fetched in.
+    '''
+    return hashlib.sha1('\n'.join(ids).encode('ascii')).hexdigest()
+
+def fetch_into_cache(eutils, cache, accessions, outfile_format,
+                     batch_size=100, jobs=3):
+    '''
+    efetch accessions by ID, batch_size at a time and `jobs` batches at
+    once, and store every record in the cache. A batch missing any of
+    its records is fetched again, up to eutils.attempts times.
+    '''
+    batches = [accessions[i:i + batch_size]
+               for i in range(0, len(accessions), batch_size)]
+
+    def fetch(batch):
+        print("Downloading %i records (%s to %s)..." %
+              (len(batch), batch[0], batch[-1]))
+        wanted = set(batch)
+        for attempt in range(1, eutils.attempts + 1):
+            data = eutils.efetch(rettype=outfile_format, id=','.join(batch))
+            for accession, record in split_records(data, outfile_format):
+                if accession in wanted:
+                    cache.put(accession, record)
+                    wanted.discard(accession)
+            if not wanted:
+                return
+            print("%i records missing from the batch" % len(wanted))
+            batch = sorted(wanted)
+        raise BatchError('could not download %s' % ', '.join(sorted(wanted)))
+
+    with ThreadPoolExecutor(max_workers=jobs) as pool:
+        # consume the results so that a failed batch raises here
+        list(pool.map(fetch, batches))
+
+def write_metadata(metadata_path, email, start_time, outfile_path,
+                   my_query, count):
+    with open(metadata_path, mode = 'a') as f:
+        f.write("User:\t" + email + "\n" +
+                "Query Date:\t" + str(start_time) + "\n" +
+                'Filename:\t' + outfile_path + "\n" +
+                "Query Terms:\t" + my_query + "\n" +
+                "N sequences:\t" + str(count) + "\n")
+
+    if outfile_path == '-':
+        print('Sequences written to standard output')
+    else:
+        print('Sequences written to file: ' + outfile_path)
+    print('Metadata written to file: ' + metadata_path)
+
+def confirm(args, question):
+    print(question)
+    if args['yes']:
+        return True
+    download = input('[y|n]: ')
+    return any(y in download for y in ["y", "Y"])
+
+def main():
+
+    args = vars(parser.parse_args())
+
+    # args will be a dictionary containing the arguments:
+
+    # when streaming, standard output only carries records; everything
+    # printed goes to standard error
+    stream = args['output'] == '-'
+    if stream:
+        stdout = sys.stdout.buffer
+        sys.stdout = sys.stderr
+
+    if args['email'] is None:
+        # you MUST enter an email address:
+        print('You must enter an email address. NCBI will contact you in case of overuse.')
+        email = input("email: ")
+    else:
+        email = args['email']
+
+    outfile_format = args['format']
+
+    start_time = datetime.now()
+    start_time_fmt = start_time.strftime('%y%m%d-%H%M%S')
+
+    if args['resume'] and (args['output'] is None or stream):
+        print("--resume needs the --output file of the interrupted download.")
+        sys.exit(1)
+    if args['output'] is None or stream:
+        outfile_base  = 'gbdl' + '_' + start_time_fmt
+    else:
+        outfile_base = args['output']
+
+    journal_path = outfile_base + '.journal'
+    journal = None
+    if args['resume']:
+        try:
+            journal = Journal.load(journal_path)
+        except (IOError, ValueError) as err:
+            print("Cannot resume, no usable journal %s (%s)" % (journal_path, err))
+            sys.exit(1)
+        my_query = journal.state['query']
+        outfile_format = journal.state['format']
+    elif args['query'] is None:
+        print('Enter a search query, for example:' + '\n' +
+        '"Poecilia wingei"[Organism] AND gene_in_mitochondrion[PROP] AND 100:1000[SLEN]')
+        my_query = input()
+        if len(my_query) < 1:
+            print("No query entered. For help, use argument -h.")
+            sys.exit()
+    else:
+        my_query = args['query']
+
+    # Example queries:
+    # my_query = '"Embiotocidae"[organism] AND gene_in_mitochondrion[PROP] AND ("cytochrome b") NOT ("COI")'
+    # my_query = '"Poecilia wingei"[Organism]'
+    # my_query = '"Boraras brigittae"[Organism]'
+    # my_query = '"Oophaga pumilio"[Organism] AND ("cytochrome"[ALL] NOT "cytochrome b"[ALL])'
+
+    outfile_path  = outfile_base + '.' + outfile_format
+    metadata_path = outfile_base + '.md'
+    if stream:
+        outfile_path = '-'
+
+    eutils = Eutils(email, api_key=args['api_key'], rate=args['rate'],
+                    url=args['eutils_url'], timeout=args['timeout'])
+
+    if args['cache'] is not None:
+        cache = RecordCache(args['cache'], outfile_format)
+        ids = search_ids(eutils, my_query)
+        count = len(ids)
+        missing = [accession for accession in ids if accession not in cache]
+        if not confirm(args, "Found %i records, %i of them already cached. "
+                             "Do you want to download the other %i?" %
+                             (count, count - len(missing), len(missing))):
+            print('Aborting.')
+            sys.exit(0)
+        fetch_into_cache(eutils, cache, missing, outfile_format,
+                         batch_size=args['batch_size'], jobs=args['jobs'])
+        if stream:
+            cache.assemble(ids, stdout)
+        else:
+            with open(outfile_path, "wb") as out_handle:
+                cache.assemble(ids, out_handle)
+        write_metadata(metadata_path, email, start_time, outfile_path,
+                       my_query, count)
+        sys.exit(0)
+
+    search_results = eutils.esearch(my_query, usehistory='y', retmax=200)
+
+    # When you get the results back, they will still include the usual search results:
+    count = int(search_results["count"])
+
+    # However, you also get given two additional pieces of information, the WebEnv session cookie, and the QueryKey:
+
+    webenv = search_results["webenv"]
+    query_key = search_results["querykey"]
+
+    # Having stored these values we can use them as parameters to efetch instead of giving the GI numbers as identifiers.
+
+    # the accessions found identify the result set, so that a resumed
+    # download can tell whether it still gets the same records
+    if not stream:
+        digest = ids_digest(search_ids(eutils, my_query))
+
+    if journal is not None:
+        # history sessions expire, so a resumed download runs the search
+        # again; the batches already written are only valid if it still
+        # finds the same records, in the same order
+        if count != journal.state['count']:
+            print("The query now finds %i records instead of %i; "
+                  "start a new download." % (count, journal.state['count']))
+            sys.exit(1)
+        if digest != journal.state.get('ids_digest'):
+            print("The query now finds other records than the interrupted "
+                  "download (or the journal does not say which it found); "
+                  "start a new download.")
+            sys.exit(1)
+        journal.state['webenv'] = webenv
+        journal.state['query_key'] = query_key
+        journal.save()
+        batch_size = journal.state['batch_size']
+        first = journal.next_start()
+        print("Resuming at record %i of %i." % (first + 1, count))
+        out_handle = open(outfile_path, "r+b")
+        out_handle.truncate(journal.output_size())
+        out_handle.seek(0, os.SEEK_END)
+    else:
+        if not confirm(args, "Found " + str(count) + " records. Do you want to download all of them?"):
+            print('Aborting.')
+            sys.exit(0)
+        batch_size = args['batch_size']
+        first = 0
+        if not stream:
+            journal = Journal.create(journal_path, my_query, outfile_format,
+                                     count, batch_size, webenv, query_key,
+                                     digest)
+            out_handle = open(outfile_path, "wb")
+
+    # While for small searches you might be OK downloading everything at once, it is better to download in batches. You use the retstart and retmax parameters to specify which range of search results you want returned (starting entry using zero-based counting, and maximum number of results to return). Sometimes you will get intermittent errors from Entrez, HTTPError 5XX; the Eutils client pauses and retries on those.
+
+    if stream:
+        download_batches(eutils, count, webenv, query_key, outfile_format,
+                         stdout, batch_size=batch_size, jobs=args['jobs'],
+                         workdir=tempfile.mkdtemp(prefix='get_genbank_'))
+    else:
+        with out_handle:
+            download_batches(eutils, count, webenv, query_key, outfile_format,
+                             out_handle, batch_size=batch_size,
+                             jobs=args['jobs'], first=first, journal=journal)
+        journal.remove()
+
+    write_metadata(metadata_path, email, start_time, outfile_path,
+                   my_query, count)
     sys.exit(0)
 
-# This fails because count is the true count of records
-# while gi_list is limited by argument retmax
-# assert count == len(gi_list)
-
-# However, you also get given two additional pieces of information, the WebEnv session cookie, and the QueryKey:
-
-webenv = search_results["WebEnv"]
-query_key = search_results["QueryKey"]
-
-# Having stored these values in variables session_cookie and query_key we can use them as parameters to Bio.Entrez.efetch() instead of giving the GI numbers as identifiers.
-
-# While for small searches you might be OK downloading everything at once, it is better to download in batches. You use the retstart and retmax parameters to specify which range of search results you want returned (starting entry using zero-based counting, and maximum number of results to return). Sometimes you will get intermittent errors from Entrez, HTTPError 5XX, we use a try except pause retry block to address this. For example,
-
-# This assumes you have already run a search as shown above,
-# and set the variables count, webenv, query_key
-
-try:
-    from urllib.error import HTTPError  # for Python 3
-except ImportError:
-    from urllib2 import HTTPError  # for Python 2
-
-# For illustrative purposes, this example downloads the FASTA records in batches of three. Unless you are downloading genomes or chromosomes, you would normally pick a larger batch size.
-batch_size = 100
-out_handle = open(outfile_path, "w")
-for start in range(0, count, batch_size):
-    end = min(count, start+batch_size)
-    print("Downloading record %i to %i..." % (start+1, end))
-    attempt = 0
-    while attempt < 3:
-        attempt += 1
-        try:
-            fetch_handle = Entrez.efetch(db=ncbi_db,
-                                         rettype=outfile_format, retmode="text",
-                                         retstart=start, retmax=batch_size,
-                                         webenv=webenv, query_key=query_key)
-        except HTTPError as err:
-            if 500 <= err.code <= 599:
-                print("Received error from server %s" % err)
-                print("Attempt %i of 3" % attempt)
-                time.sleep(15)
-            else:
-                raise
-    data = fetch_handle.read()
-    fetch_handle.close()
-    out_handle.write(data)
-out_handle.close()
-
-
-with open(metadata_path, mode = 'a') as f:
-    f.write("User:\t" + Entrez.email + "\n" + 
-            "Query Date:\t" + str(start_time) + "\n" +
-            'Filename:\t' + outfile_path + "\n" +
-            "Query Terms:\t" + my_query + "\n" +
-            "N sequences:\t" + str(count) + "\n")
-f.close()
-
-print('Sequences written to file: ' + outfile_path)
-print('Metadata written to file: ' + metadata_path)
-
-sys.exit(0)
+if __name__ == '__main__':
+    main()
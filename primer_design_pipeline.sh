@@ -4,6 +4,10 @@
 # Author: Jimmy O'Donnell <jodonnellbio@gmail.com>
 ################################################################################
 
+# stop at the first failing step, including a failed download at the head of
+# a pipe, instead of building on partial output
+set -euo pipefail
+
 # set a basename for files
 FILEBASE="embio_wa_cytb"
 
@@ -12,21 +16,21 @@ FILEBASE="embio_wa_cytb"
 #-------------------------------------------------------------------------------
 MYQUERY='"Embiotocidae"[organism] NOT Ditrema[organism] NOT Neoditrema[organism] AND gene_in_mitochondrion[PROP] AND ("cytochrome b") NOT ("COI")'
 
-./get_genbank.py -e jimmyod@uw.edu -q "${MYQUERY}" -f gb -o "${FILEBASE}"
-
 #-------------------------------------------------------------------------------
-# Create eco* database
+# and create eco* database, with a fasta copy for the alignment
 #-------------------------------------------------------------------------------
+# the records are piped straight into ecodb_maker.py as they are downloaded;
+# tee keeps a GenBank copy
 TAXDUMP="/Users/jimmy.odonnell/Data/NCBI/databases/taxonomy/taxdump"
-./ecodb_maker.py --input "${FILEBASE}".gb -t "$TAXDUMP" -o "${FILEBASE}"
+./get_genbank.py -e jimmyod@uw.edu -q "${MYQUERY}" -f gb -o - -y |
+  tee "${FILEBASE}".gb |
+  ./ecodb_maker.py --input - -t "$TAXDUMP" -o "${FILEBASE}" \
+    --fasta-out "${FILEBASE}".fasta
 
 
 #-------------------------------------------------------------------------------
 # Create an alignment
 #-------------------------------------------------------------------------------
-# make a fasta copy
-./gb_to_fasta.py -i "${FILEBASE}".gb
-
 # correct orientation while aligning
 mafft --adjustdirectionaccurately --maxiterate 1000 --localpair \
   "${FILEBASE}".fasta > "${FILEBASE}".aln
@@ -39,7 +43,7 @@ mafft --adjustdirectionaccurately --maxiterate 1000 --localpair \
 #-------------------------------------------------------------------------------
 # Filter ecoprimer results
 #-------------------------------------------------------------------------------
-Rscript ecoprimer_filter.R "${FILEBASE}"_ecoprimers.tsv
+./ecoprimer_filter.py "${FILEBASE}"_ecoprimers.tsv
 
 #-------------------------------------------------------------------------------
 # Align primers to database
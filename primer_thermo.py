@@ -0,0 +1,333 @@
+#!/usr/bin/env python3
+
+'''
+--------------------------------------------------------------------------------
+Nearest-neighbor thermodynamics of primers
+
+Melting temperatures follow the unified nearest-neighbor parameters of
+SantaLucia (1998, PNAS 95:1460-1465) with his salt correction, at the
+salt concentration given to ecoPrimers (SALT_CONC in ecoprimer_wrap.sh).
+Primer-dimers and hairpins are scored by the free energy (kcal/mol) of
+the most stable Watson-Crick stem that holds the 3' end of a primer,
+since only those can be extended by the polymerase; stems take the
+same stack energies, and hairpin loops the loop initiation energies of
+SantaLucia & Hicks (2004, Annu Rev Biophys 33:415-440).
+
+Primers are encoded once as rows of a base code matrix, right-aligned
+so that 3' ends share the last column, and every score is computed for
+all the primers (or pairs) of a batch at once with lookup tables.
+Values per oligo are kept in a cache, so each distinct primer is only
+scored once however many pairs it is part of.
+
+Usage:
+  ./primer_thermo.py AAAGCGGCACTTGTGAAGTGTT      # Tm, hairpin, self-dimer
+  ./primer_thermo.py AAAGCGGCACTTGTGAAGTGTT CCCCACGCCGCTTGGGTCTTCT
+
+--------------------------------------------------------------------------------
+'''
+
+import sys
+import argparse
+
+import numpy as np
+
+#####
+#
+#
+# Parameters
+#
+#
+#####
+
+SALT_CONC   = 0.05    # M, as in ecoprimer_wrap.sh
+PRIMER_CONC = 8e-7    # M, primers in large excess over their target
+TEMPERATURE = 37.0    # degrees C, for the free energies
+
+R = 1.987             # cal/K/mol
+
+# base codes; 4 is anything else (ambiguity, padding)
+BASES = b'ACGT'
+_code = np.full(256, 4, dtype=np.uint8)
+for _i, _b in enumerate(BASES):
+    _code[_b] = _i
+    _code[ord(chr(_b).lower())] = _i
+# code of the complement; 5 matches no code, padding included
+_comp = np.array([3, 2, 1, 0, 5], dtype=np.uint8)
+
+# SantaLucia 1998 table 2: 5'-XY-3'/3'-X'Y'-5' stacks,
+# delta H (kcal/mol) and delta S (cal/K/mol)
+_stacks = {
+    b'AA': (-7.9, -22.2), b'TT': (-7.9, -22.2),
+    b'AT': (-7.2, -20.4),
+    b'TA': (-7.2, -21.3),
+    b'CA': (-8.5, -22.7), b'TG': (-8.5, -22.7),
+    b'GT': (-8.4, -22.4), b'AC': (-8.4, -22.4),
+    b'CT': (-7.8, -21.0), b'AG': (-7.8, -21.0),
+    b'GA': (-8.2, -22.2), b'TC': (-8.2, -22.2),
+    b'CG': (-10.6, -27.2),
+    b'GC': (-9.8, -24.4),
+    b'GG': (-8.0, -19.9), b'CC': (-8.0, -19.9),
+}
+
+# initiation, for each end of a duplex, by its terminal base pair
+_initH = np.array([2.3, 0.1, 0.1, 2.3])
+_initS = np.array([4.1, -2.8, -2.8, 4.1])
+_symmetryS = -1.4
+
+# SantaLucia & Hicks 2004 table 4: hairpin loop initiation, delta G37
+_loops = {3: 3.5, 4: 3.5, 5: 3.3, 6: 4.0, 7: 4.2, 8: 4.3, 9: 4.5, 10: 4.6,
+          12: 5.0, 14: 5.1, 16: 5.3, 18: 5.5, 20: 5.7, 25: 6.1, 30: 6.3}
+
+def _stack_table(index):
+    '''
+    Stack parameter (0: delta H, 1: delta S) by code X * 5 + Y; stacks
+    with a non-ACGT base get 0 and are masked by the callers.
+    '''
+    table = np.zeros(25)
+    for stack, values in _stacks.items():
+        table[_code[stack[0]] * 5 + _code[stack[1]]] = values[index]
+    return table
+
+_stackH = _stack_table(0)
+_stackS = _stack_table(1)
+
+def loop_dg(length, temperature=TEMPERATURE):
+    '''
+    Free energy of hairpin loops of the given lengths (3 or more),
+    interpolated between the tabulated ones and extrapolated beyond 30
+    as in SantaLucia & Hicks 2004; loops are taken as purely entropic.
+    '''
+    sizes = sorted(_loops)
+    dg = np.interp(length, sizes, [_loops[s] for s in sizes])
+    far = np.asarray(length) > sizes[-1]
+    dg = np.where(far, _loops[sizes[-1]] +
+                  2.44 * R * 310.15 / 1000 *
+                  np.log(np.maximum(length, 1) / sizes[-1]), dg)
+    return dg * (temperature + 273.15) / 310.15
+
+#####
+#
+#
+# Encoding
+#
+#
+#####
+
+def encode(oligos):
+    '''
+    Base codes of an array of oligos (bytes, either case) as the rows
+    of a uint8 matrix, right-aligned and padded on the left with 4.
+    Returns (codes, lengths).
+    '''
+    oligos = np.ascontiguousarray(oligos, dtype=bytes)
+    width = max(oligos.dtype.itemsize, 1)
+    chars = np.frombuffer(oligos.tobytes(), dtype=np.uint8)
+    chars = chars.reshape(len(oligos), width)
+    lengths = np.char.str_len(oligos)
+    # column i of the result is column i - (width - length) of chars
+    source = np.arange(width) - (width - lengths)[:, None]
+    codes = _code[np.take_along_axis(chars, np.maximum(source, 0), axis=1)]
+    codes[source < 0] = 4
+    return codes, lengths
+
+#####
+#
+#
+# Scores
+#
+#
+#####
+
+class NearestNeighbor(object):
+    '''
+    Tm and 3' dimer and hairpin free energies at one salt and primer
+    concentration. Per oligo values are cached in dicts, so a single
+    instance should be kept for a whole table.
+    '''
+
+    def __init__(self, salt=SALT_CONC, conc=PRIMER_CONC,
+                 temperature=TEMPERATURE):
+        self.salt = salt
+        self.conc = conc
+        self.temperature = temperature
+        # salt correction of SantaLucia 1998, by phosphate (stack)
+        self._saltS = 0.368 * np.log(salt)
+        kelvin = temperature + 273.15
+        self._stackG = _stackH - kelvin * (_stackS + self._saltS) / 1000
+        self._initG = _initH - kelvin * _initS / 1000
+        self._tm = {}
+        self._hairpin = {}
+        self._dimer = {}
+
+    # per oligo values, through the caches
+
+    def _cached(self, cache, compute, oligos):
+        oligos = np.asarray(oligos, dtype=bytes)
+        if len(oligos) == 0:
+            return np.zeros(0)
+        unique, inverse = np.unique(oligos, return_inverse=True)
+        missing = np.array([o not in cache for o in unique.tolist()])
+        if missing.any():
+            todo = unique[missing]
+            cache.update(zip(todo.tolist(), compute(todo).tolist()))
+        values = np.array([cache[o] for o in unique.tolist()])
+        return values[inverse.reshape(-1)]
+
+    def tm(self, oligos):
+        '''
+        Melting temperatures (degrees C) of oligos against their exact
+        complement; nan for the ones with a base other than ACGT.
+        '''
+        return self._cached(self._tm, self._tm_batch, oligos)
+
+    def hairpin(self, oligos):
+        '''
+        Free energy of the most stable hairpin holding the 3' end of
+        each oligo, or 0 when there is none.
+        '''
+        return self._cached(self._hairpin, self._hairpin_batch, oligos)
+
+    def self_dimer(self, oligos):
+        '''
+        3' dimer free energy of each oligo with itself.
+        '''
+        return self._cached(self._dimer, self._self_dimer_batch, oligos)
+
+    def pair_dimer(self, primers1, primers2):
+        '''
+        3' dimer free energy between the primers of each pair, the most
+        stable of the 3' end of either primer on the other. Each
+        distinct pair is scored once.
+        '''
+        primers1 = np.asarray(primers1, dtype=bytes)
+        primers2 = np.asarray(primers2, dtype=bytes)
+        if len(primers1) == 0:
+            return np.zeros(0)
+        keys = np.char.add(np.char.add(primers1, b' '), primers2)
+        unique, first, inverse = np.unique(keys, return_index=True,
+                                           return_inverse=True)
+        codes, lengths = encode(np.concatenate((primers1[first],
+                                                primers2[first])))
+        codes1, codes2 = codes[:len(first)], codes[len(first):]
+        dg = np.minimum(self._dimer_codes(codes1, codes2),
+                        self._dimer_codes(codes2, codes1))
+        return dg[inverse.reshape(-1)]
+
+    # batches of distinct oligos
+
+    def _tm_batch(self, oligos):
+        codes, lengths = encode(oligos)
+        valid = codes < 4
+        stacks = codes[:, :-1] * 5 + codes[:, 1:]
+        inside = valid[:, :-1] & valid[:, 1:]
+        width = codes.shape[1]
+        first = codes[np.arange(len(codes)),
+                      np.minimum(width - lengths, width - 1)]
+        last = codes[:, -1]
+        ok = valid.sum(axis=1) == lengths
+        first = np.where(ok, first, 0)
+        last = np.where(ok, last, 0)
+        dh = (_stackH[stacks] * inside).sum(axis=1) + _initH[first] + \
+             _initH[last]
+        ds = (_stackS[stacks] * inside).sum(axis=1) + _initS[first] + \
+             _initS[last] + self._saltS * (lengths - 1)
+        symmetric = np.array([o == reverse_complement(o)
+                              for o in oligos.tolist()], dtype=bool)
+        ds = ds + np.where(symmetric, _symmetryS, 0)
+        tm = 1000 * dh / (ds + R * np.log(self.conc)) - 273.15
+        return np.where(ok & (lengths > 1), tm, np.nan)
+
+    def _self_dimer_batch(self, oligos):
+        codes, lengths = encode(oligos)
+        return self._dimer_codes(codes, codes)
+
+    def _dimer_codes(self, codes1, codes2):
+        '''
+        Most stable stem holding the 3' end of each row of codes1,
+        antiparallel on the same row of codes2.
+        '''
+        n, width1 = codes1.shape
+        # primer 2 from its 3' end, the way it lies under primer 1
+        under = codes2[:, ::-1]
+        # stems are grown from the 3' end of primer 1 inwards, for every
+        # (row, base of primer 2 facing that end) that pairs; few of
+        # them last more than a couple of bases
+        rows, shifts = np.nonzero(_comp[codes1[:, -1]][:, None] == under)
+        end = self._initG[codes1[rows, -1]]
+        dg = np.zeros(len(rows))
+        found = []
+        for k in range(1, width1 + 1):
+            # the stems hold k pairs, inner is the 5'-most one
+            inner = codes1[rows, width1 - k]
+            if k == width1:
+                found.append((rows, dg + end + self._initG[inner]))
+                break
+            column = codes1[rows, width1 - 1 - k]
+            facing = under[rows, np.maximum(shifts - k, 0)]
+            paired = (shifts >= k) & (_comp[column] == facing)
+            if k >= 2:
+                stop = ~paired
+                found.append((rows[stop], dg[stop] + end[stop] +
+                              self._initG[inner[stop]]))
+            rows, shifts, end = rows[paired], shifts[paired], end[paired]
+            dg = dg[paired] + self._stackG[column[paired] * 5 + inner[paired]]
+            if not len(rows):
+                break
+        best = np.zeros(n)
+        for stems, values in found:
+            np.minimum.at(best, stems, values)
+        return best
+
+    def _hairpin_batch(self, oligos):
+        codes, lengths = encode(oligos)
+        n, width = codes.shape
+        complement = _comp[codes]
+        # the 3' side of the stem, from the 3' end inwards
+        tail = complement[:, ::-1]
+        best = np.zeros(n)
+        for start in range(width):
+            # 5' side of the stem from start, with a loop of 3 or more
+            most = (width - start - 3) // 2
+            if most < 2:
+                break
+            paired = codes[:, start:start + most] == tail[:, :most]
+            stem = np.cumprod(paired, axis=1).astype(bool)
+            stacks = self._stackG[codes[:, start:start + most - 1] * 5 +
+                                  codes[:, start + 1:start + most]]
+            dg = np.cumsum(stacks * stem[:, 1:], axis=1)
+            sizes = np.arange(2, most + 1)
+            dg = dg + loop_dg(width - 2 * sizes - start, self.temperature)
+            best = np.minimum(best, np.where(stem[:, 1:], dg, 0).min(axis=1))
+        return best
+
+_complement = bytes.maketrans(b'ACGTacgt', b'TGCAtgca')
+
+def reverse_complement(oligo):
+    return oligo.translate(_complement)[::-1]
+
+parser = argparse.ArgumentParser(
+  description = 'Nearest-neighbor Tm, hairpin and 3\' dimer free energies')
+
+parser.add_argument('primers', nargs = '+',
+  help = 'primer sequences; with two, the dimer of the pair is also given')
+
+parser.add_argument('--salt', type = float, default = SALT_CONC,
+  help = 'monovalent salt concentration in M (default: %g)' % SALT_CONC)
+
+parser.add_argument('--conc', type = float, default = PRIMER_CONC,
+  help = 'primer concentration in M (default: %g)' % PRIMER_CONC)
+
+if __name__ == '__main__':
+
+    args = parser.parse_args()
+
+    thermo = NearestNeighbor(args.salt, args.conc)
+    primers = np.array([p.encode('ascii') for p in args.primers])
+    for primer, tm, hairpin, dimer in zip(args.primers, thermo.tm(primers),
+                                          thermo.hairpin(primers),
+                                          thermo.self_dimer(primers)):
+        sys.stdout.write('%s\tTm %.1f\thairpin %.2f\tself-dimer %.2f\n' %
+                         (primer, tm, hairpin, dimer))
+    if len(primers) == 2:
+        sys.stdout.write('pair dimer %.2f\n' %
+                         thermo.pair_dimer(primers[:1], primers[1:])[0])